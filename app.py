@@ -2,9 +2,9 @@
 # Website to search upcoming availability of foods from UT Austin dining halls
 
 from datetime import datetime, timedelta
-from flask import Flask, request, render_template
-from searchdb import load_menu_details, load_menu_home, MFilters
-from predict_dates import get_predictions
+from flask import Flask, request, render_template, jsonify
+from searchdb import load_food_details, load_menu_home, suggest_recipes, MFilters
+from predict_dates import get_prediction_entry
 
 app = Flask(__name__)
 
@@ -58,54 +58,45 @@ def details():
     tmr_str = get_datestr(datetime.today() + timedelta(days=1))
 
     # Get details
+    future_menu, past_menu, prediction_entry = [], [], []
     if food_name != '':
         # check if a button was clicked and update results accordingly
+        button_clicked = False
         for i in range(MFilters.NUM_FILTERS.value):
             # check which button (filter1, filter2, ...) was clicked
             if 'filters{}'.format(i) in request.args: 
-                # toggle the specific filter option. for time, 
+                # toggle the specific filter option
                 filters_list = list(filters_str)
                 filters_list[i] = '0' if filters_list[i] == '1' else '1'
                 filters_str = ''.join(filters_list)
+                button_clicked = True
+                break
 
-                # recode filter for details page toggles: future/all time visibility
-                filters_list[0] = '1' if filters_list[0] == '0' else '2'
-                recoded_filter = ''.join(filters_list)
-                
-                # query database with filters for the future and past
-                filters_list[0] = str(MFilters.TIME_FUTURE.value)
-                future_menu_filters = ''.join(filters_list)
-                future_menu = load_menu_details(food_name, future_menu_filters)
-
-                filters_list[0] = str(MFilters.TIME_PAST.value)
-                past_menu_filters = ''.join(filters_list)
-                past_menu = load_menu_details(food_name, past_menu_filters)
-
-                prediction_entry = get_predictions (food_name)
-
-                return render_template('details.html', future_menu = future_menu, past_menu = past_menu, 
-                                       search = food_name, filters = filters_str, today_str = today_str, 
-                                       tmr_str = tmr_str, prediction_entry = prediction_entry)
-        
-        # else, no button was clicked. It was the initial load of details page. 
-
-        # query database with filters for the future and past
-        future_menu_filters = str(MFilters.TIME_FUTURE.value) + filters_str[1:]
-        future_menu = load_menu_details(food_name, future_menu_filters)
+        # query database for the future and past, predictions are kept in memory
+        future_menu, past_menu, predictions = load_food_details(food_name, filters_str)
+        prediction_entry = get_prediction_entry(predictions)
 
-        past_menu_filters = str(MFilters.TIME_PAST.value) + filters_str[1:]
-        past_menu = load_menu_details(food_name, past_menu_filters)
+        if button_clicked:
+            return render_template('details.html', future_menu = future_menu, past_menu = past_menu, 
+                                   search = food_name, filters = filters_str, today_str = today_str, 
+                                   tmr_str = tmr_str, prediction_entry = prediction_entry)
+        # else, no button was clicked. It was the initial load of details page. 
 
     else:
         # Somehow got '' (can happen when user manually types in URL)
         food_name = 'Error retrieving food name. No'
 
-    prediction_entry = get_predictions (food_name)
-
     return render_template('details.html', search = food_name, future_menu = future_menu, 
                            past_menu = past_menu, today_str = today_str, tmr_str = tmr_str, 
                            prediction_entry = prediction_entry)
 
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    """ returns JSON list of food names starting with the typed text, for the search bar """
+    food_name = request.args.get('q', '')  # user input, partially typed food name
+    limit = request.args.get('limit', 8, type=int)  # number of suggestions
+    return jsonify(suggest_recipes(food_name, limit))
+
 def validate_filters(filters_str: str):
     """ checks that filters_str is valid and returns a corrected string otherwise """
 
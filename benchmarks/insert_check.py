@@ -0,0 +1,68 @@
+# insert_check.py
+# checks that searchdb.insert_rows writes every row, in batches smaller than the number of rows,
+# against a local SQLite database standing in for Azure SQL, with pyodbc's fast_executemany
+# turned on for the batches and restored afterwards. Run from the repository root:
+#   python benchmarks/insert_check.py [--rows 20001] [--batch-size 1000]
+# Exits with status 1 if the rows written, the batches, or fast_executemany differ
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from searchdb import insert_rows
+
+TABLE_NAME = 'menu_insert_check'
+COLUMNS = ['Recipe', '[Date]', 'Mealtime', '[Location]']
+
+class CountingCursor:
+    """ sqlite3 cursor with pyodbc's fast_executemany attribute, that records the rows in each
+    executemany call and whether fast_executemany was on for it """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+        self.fast_executemany = False
+        self.batches = []
+
+    def executemany(self, query: str, rows: list):
+        self.batches.append((len(rows), self.fast_executemany))
+        return self.cursor.executemany(query, rows)
+
+def make_rows(num_rows: int):
+    """ returns num_rows menu rows, each different """
+    start = datetime(2025, 1, 1)
+    return [(f'Recipe {i}', start + timedelta(days=i % 365), i % 3 + 1, i % 3 + 1) for i in range(num_rows)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Check batched inserts against SQLite')
+    parser.add_argument('--rows', type=int, default=20001)
+    parser.add_argument('--batch-size', type=int, default=1000, help='must be smaller than --rows to check batching')
+    args = parser.parse_args()
+    rows = make_rows(args.rows)
+
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(os.path.join(directory, 'insert_check.db'))
+        connection.execute(f'CREATE TABLE {TABLE_NAME} (Recipe varchar(65), [Date] timestamp, Mealtime int, [Location] int)')
+        cursor = CountingCursor(connection.cursor())
+        insert_rows(cursor, TABLE_NAME, COLUMNS, rows, batch_size=args.batch_size)
+        connection.commit()
+        written = connection.execute(f'SELECT Recipe, [Date], Mealtime, [Location] FROM {TABLE_NAME} ORDER BY rowid').fetchall()
+        connection.close()
+
+    expected_batches = [(min(args.batch_size, args.rows - start), True) for start in range(0, args.rows, args.batch_size)]
+    rows_match = [(recipe, datetime.fromisoformat(date), mealtime, location)
+                  for recipe, date, mealtime, location in written] == rows
+    batches_match = cursor.batches == expected_batches
+    restored = cursor.fast_executemany is False
+    print(f'rows written match: {rows_match}, {len(written)} rows')
+    print(f'batches match: {batches_match}, {len(cursor.batches)} batches of at most {args.batch_size}, '\
+          f'fast_executemany on for each: {all(fast for _, fast in cursor.batches)}')
+    print(f'fast_executemany restored: {restored}')
+
+    sys.exit(0 if rows_match and batches_match and restored and args.batch_size < args.rows else 1)
+
+if __name__ == '__main__':
+    main()
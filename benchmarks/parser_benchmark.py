@@ -0,0 +1,79 @@
+# parser_benchmark.py
+# checks that scraper.parse_menu extracts the same (mealtime, recipe) pairs as the BeautifulSoup
+# extraction it replaced, and compares their speed. Run from the repository root:
+#   python benchmarks/parser_benchmark.py [directory of saved menu pages]
+# pages default to benchmarks/sample_pages. Pages archived by run_scraper can be checked with
+#   python benchmarks/parser_benchmark.py static/archive/objects
+# requires beautifulsoup4 for the reference parser. Exits with status 1 if any page differs
+
+import gzip
+import os
+import sys
+import time
+from bs4 import BeautifulSoup
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'static')))
+from scraper import parse_menu, MENU_TABLE_ATTRS, NO_DATA_TEXT
+
+SAMPLE_PAGES_DIR = os.path.join(os.path.dirname(__file__), 'sample_pages')
+
+def parse_menu_reference(page: str):
+    """ returns list of (mealtime, recipe) on a menu page, or None if the page has no data, the
+    way scraper.write used to with BeautifulSoup """
+    html_content = BeautifulSoup(page, 'html.parser')
+    if html_content.find(string=NO_DATA_TEXT):
+        return None
+
+    menu_items = []
+    for menu in html_content.find_all('table', MENU_TABLE_ATTRS):
+        mealtime = menu.find('div', class_='shortmenumeals').text
+        recipe_list_raw = menu.find('tr').find_next_sibling().find_all('div', class_='shortmenurecipes')
+
+        # Remove duplicates. Tags are compared with their markup, so the same recipe written
+        # twice with different styling was kept twice. parse_menu compares text only
+        recipe_list = []
+        [recipe_list.append(x) for x in recipe_list_raw if x not in recipe_list]
+        menu_items.extend((mealtime, recipe.text.rstrip('\xa0')) for recipe in recipe_list)
+    return menu_items
+
+def dedupe(menu_items: list):
+    """ returns menu_items without repeated (mealtime, recipe), keeping the first of each """
+    return None if menu_items is None else list(dict.fromkeys(menu_items))
+
+def list_pages(pages_dir: str):
+    """ returns paths of saved .html and archived .html.gz pages in pages_dir and its subdirectories """
+    return [os.path.join(directory, file_name) for directory, _, file_names in os.walk(pages_dir)
+            for file_name in file_names if file_name.endswith(('.html', '.html.gz'))]
+
+def time_parser(parser, page: str, repeats: int):
+    """ returns average milliseconds parser takes on page """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        parser(page)
+    return (time.perf_counter() - start) * 1000 / repeats
+
+def main():
+    pages_dir = sys.argv[1] if len(sys.argv) > 1 else SAMPLE_PAGES_DIR
+    all_match = True
+
+    print(f'{"page":<28} {"items":>6} {"match":>6} {"bs4 ms":>8} {"new ms":>8} {"speedup":>8}')
+    for file_name in sorted(list_pages(pages_dir)):
+        with (gzip.open if file_name.endswith('.gz') else open)(file_name, 'rt', encoding='utf-8') as file:
+            page = file.read()
+        expected, actual = parse_menu_reference(page), parse_menu(page)
+
+        # the reference keeps differently styled copies of a recipe, which are the same row to us
+        match = dedupe(expected) == actual
+        all_match = all_match and match
+        if expected is not None and len(expected) != len(actual):
+            print(f'  {os.path.basename(file_name)}: reference had {len(expected) - len(actual)} duplicate recipes')
+
+        reference_ms, parser_ms = time_parser(parse_menu_reference, page, 20), time_parser(parse_menu, page, 20)
+        items = 'none' if actual is None else len(actual)
+        print(f'{os.path.basename(file_name)[:28]:<28} {items:>6} {str(match):>6} {reference_ms:>8.2f} {parser_ms:>8.2f} '\
+              f'{reference_ms / parser_ms:>7.1f}x')
+
+    sys.exit(0 if all_match else 1)
+
+if __name__ == '__main__':
+    main()
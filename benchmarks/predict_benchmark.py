@@ -0,0 +1,85 @@
+# predict_benchmark.py
+# checks that predict_future_date.predict_food_days forecasts the same dates as the per-food loop
+# it replaced, and compares their speed as the number of foods grows. Run from the repository root:
+#   python benchmarks/predict_benchmark.py [--foods 100 500 2000] [--appearances 20] [--seed 0]
+# Exits with status 1 if any forecast differs
+
+import argparse
+import os
+import random
+import sys
+import time
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from predict_future_date import make_food_model, predict_food_days
+from searchdb import NUM_PREDICTIONS
+
+def predict_food_days_reference(model, food_dining_db):
+    """ returns DataFrame of predicted dates for each food, the way predict_food_days used to with
+    one model.predict call per food and step """
+    food_groups = food_dining_db.groupby('Food')
+    predictions = {}
+
+    for food, group in food_groups:
+        predicted_dates = [group['Date(Datetime)'].iloc[-1]]
+        last_gap = group['Gap'].iloc[-1]
+
+        for _ in range(NUM_PREDICTIONS):
+            predicted_gap = model.predict([[last_gap]])
+            next_date = predicted_dates[-1] + pd.Timedelta(days=predicted_gap[0])
+            predicted_dates.append(next_date)
+            last_gap = predicted_gap[0]
+
+        predictions[food] = predicted_dates[1:]
+
+    return pd.DataFrame.from_dict(predictions)
+
+def make_dining_db(num_foods: int, appearances: int, rng: random.Random):
+    """ returns dataframe shaped like one dining hall's rows in incremental_training.train_location, where each food
+    repeats with its own typical gap. Some foods appear only once, so their last gap is NaN """
+    rows = []
+    start = pd.Timestamp(2024, 1, 1)
+    for food_num in range(num_foods):
+        food = f'Food {food_num:05d}'
+        typical_gap = rng.randint(1, 21)
+        date = start + pd.Timedelta(days=rng.randint(0, 30))
+        for _ in range(1 if food_num % 17 == 0 else appearances):
+            rows.append((food, date))
+            date += pd.Timedelta(days=max(1, typical_gap + rng.randint(-3, 3)))
+
+    food_dining_db = pd.DataFrame(rows, columns=['Food', 'Date(Datetime)']).sort_values(['Food', 'Date(Datetime)'])
+    food_dining_db['Gap'] = food_dining_db.groupby('Food')['Date(Datetime)'].diff().dt.days
+    return food_dining_db
+
+def time_function(function, *args):
+    """ returns (result, seconds taken) of calling function """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare batched and per-food forecasting')
+    parser.add_argument('--foods', type=int, nargs='+', default=[100, 500, 2000], help='numbers of foods to try')
+    parser.add_argument('--appearances', type=int, default=20, help='appearances of each food')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    all_match = True
+
+    print(f'{"foods":>6} {"match":>6} {"loop s":>8} {"batch s":>8} {"speedup":>8}')
+    for num_foods in args.foods:
+        food_dining_db = make_dining_db(num_foods, args.appearances, random.Random(args.seed))
+        model = make_food_model(food_dining_db)
+
+        expected, reference_seconds = time_function(predict_food_days_reference, model, food_dining_db)
+        actual, batch_seconds = time_function(predict_food_days, model, food_dining_db)
+        # compare instants, since the loop's resolution follows pandas' Timestamp arithmetic
+        match = expected.astype('datetime64[ns]').equals(actual.astype('datetime64[ns]'))
+        all_match = all_match and match
+        print(f'{num_foods:>6} {str(match):>6} {reference_seconds:>8.3f} {batch_seconds:>8.3f} '\
+              f'{reference_seconds / batch_seconds:>7.1f}x')
+
+    sys.exit(0 if all_match else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# search_benchmark.py
+# measures how searching scales with months of history, using the local SQLite replica backend
+# seeded with synthetic monthly tables. Run from the repository root:
+#   python benchmarks/search_benchmark.py --months 24 --vocab 3000 --recipes-per-meal 40
+# requires pytz, pandas, and pyodbc to be installed (searchdb imports them), but no database server
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# use the SQLite replica as a stand-in for the database, before searchdb reads the settings
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ.setdefault('DB_TABLE_PREFIX', 'menu')
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import searchdb
+from replica import GENERATION_COLUMNS, MENU_COLUMNS, PREDICTION_COLUMNS, write_table
+
+# words used to build synthetic recipe names
+ADJECTIVES = ['Grilled', 'Fried', 'Roasted', 'Spicy', 'Sweet', 'Smoked', 'Baked', 'Steamed',
+              'Crispy', 'Garlic', 'Honey', 'Lemon', 'BBQ', 'Cajun', 'Herb', 'Teriyaki']
+NOUNS = ['Chicken', 'Brisket', 'Pizza', 'Tacos', 'Rice', 'Beans', 'Salmon', 'Tofu', 'Pasta',
+         'Potatoes', 'Broccoli', 'Soup', 'Salad', 'Burger', 'Noodles', 'Pancakes', 'Eggs', 'Pie']
+
+# filter toggles to benchmark: everything, one mealtime at one location, and a mix
+TOGGLES = ['111111', '001100', '110011']
+
+def make_vocabulary(size: int, rng: random.Random):
+    """ returns list of distinct synthetic recipe names """
+    names = set()
+    while len(names) < size:
+        words = [rng.choice(ADJECTIVES), rng.choice(NOUNS)]
+        if rng.random() < 0.5:
+            words.append(f'{rng.choice(NOUNS)} {rng.randint(1, size)}')
+        names.add(' '.join(words))
+    return sorted(names)
+
+def seed_database(path: str, last_month: datetime, num_months: int, vocabulary: list,
+                  recipes_per_meal: int, rng: random.Random):
+    """ creates num_months monthly tables ending at last_month, plus empty prediction and scrape
+    log tables, and returns the first month """
+    connection = searchdb.get_replica_connection(path)
+    cursor = connection.cursor()
+    month = last_month
+    for _ in range(num_months - 1):
+        month = searchdb.get_month_start(month - timedelta(days=1))
+    first_month = month
+
+    # each day, each dining hall serves recipes_per_meal recipes at each mealtime
+    while month <= last_month:
+        rows = []
+        date = month
+        while date < searchdb.get_next_month(month):
+            for location in range(1, len(searchdb.LOCATION_CODES)):
+                for mealtime in range(1, len(searchdb.MEALTIME_CODES)):
+                    for recipe in rng.sample(vocabulary, recipes_per_meal):
+                        rows.append((recipe, date, mealtime, location))
+            date += timedelta(days=1)
+        write_table(cursor, searchdb.get_table_name(month), MENU_COLUMNS, rows)
+        month = searchdb.get_next_month(month)
+    write_table(cursor, searchdb.PREDICTION_TABLE_NAME, PREDICTION_COLUMNS, [])
+    write_table(cursor, searchdb.GENERATION_TABLE_NAME, GENERATION_COLUMNS, [])
+    cursor.execute(f'CREATE TABLE {searchdb.SCRAPE_LOG_TABLE_NAME} (Completed timestamp)')
+    connection.commit()
+    connection.close()
+    return first_month
+
+def time_calls(function, args_list: list):
+    """ returns list of milliseconds taken by each call, skipping the search cache """
+    timings = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # hide search logs
+        for args in args_list:
+            searchdb.search_cache.clear()
+            start = time.perf_counter()
+            function(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(timings: list):
+    """ returns dictionary of latency percentiles in milliseconds """
+    percentiles = statistics.quantiles(timings, n=100, method='inclusive')
+    return {'p50': percentiles[49], 'p90': percentiles[89], 'p99': percentiles[98], 'calls': len(timings)}
+
+def run_suite(today: datetime, vocabulary: list, iterations: int, rng: random.Random):
+    """ returns dictionary of mode name: latency summary for searches made on today """
+    searchdb.get_today = lambda: today
+
+    # load table names and recipe index up front, as a running web app would have
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with searchdb.borrow_connection() as connection:
+            searchdb.menu_catalog.refresh(connection.cursor())
+            searchdb.recipe_index.refresh(connection.cursor())
+
+    words = ADJECTIVES + NOUNS
+    results = {}
+    for toggles in TOGGLES:
+        for time_filter in ['0', '1']:
+            searches = [(rng.choice(words).lower()[:rng.randint(3, 6)], time_filter + toggles)
+                        for _ in range(iterations)]
+            results[f'home time={time_filter} toggles={toggles}'] = summarize(time_calls(searchdb.load_menu_home, searches))
+        for time_filter in ['0', '1', '2']:
+            searches = [(rng.choice(vocabulary), time_filter + toggles) for _ in range(iterations)]
+            results[f'details time={time_filter} toggles={toggles}'] = summarize(time_calls(searchdb.load_menu_details, searches))
+        searches = [(rng.choice(vocabulary), '0' + toggles) for _ in range(iterations)]
+        results[f'food_details toggles={toggles}'] = summarize(time_calls(searchdb.load_food_details, searches))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark search latency on a synthetic SQLite database')
+    parser.add_argument('--months', type=int, default=12, help='months of history to generate, including next month')
+    parser.add_argument('--vocab', type=int, default=2000, help='number of distinct recipe names')
+    parser.add_argument('--recipes-per-meal', type=int, default=30, help='recipes per mealtime per dining hall per day')
+    parser.add_argument('--iterations', type=int, default=50, help='searches per mode')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocab, rng)
+
+    # the scraper reads ahead, so next month's table exists by the end of this month
+    this_month = searchdb.get_month_start(searchdb.get_today())
+    last_month = searchdb.get_next_month(this_month)
+    last_day = last_month - timedelta(days=1)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.db')
+        os.environ['DB_REPLICA_PATH'] = path
+        print(f'Seeding {args.months} months, {args.vocab} recipes, {args.recipes_per_meal} recipes per meal...')
+        searchdb.FIRST_TABLE_DATE = seed_database(path, last_month, args.months, vocabulary,
+                                                  args.recipes_per_meal, rng)
+
+        # mid month searches one table for TIME_SHORT, the last day of the month searches two
+        all_results = {}
+        for label, day in [('mid-month', this_month + timedelta(days=14)), ('cross-month', last_day)]:
+            results = run_suite(day, vocabulary, args.iterations, rng)
+            all_results[label] = results
+            print(f'\n{label} ({day.date()})')
+            print(f'{"mode":<40} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8}')
+            for mode, summary in results.items():
+                print(f'{mode:<40} {summary["p50"]:>8.2f} {summary["p90"]:>8.2f} {summary["p99"]:>8.2f}')
+        searchdb.get_pool().close_all()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'args': vars(args), 'results': all_results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
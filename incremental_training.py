@@ -0,0 +1,166 @@
+# incremental_training.py
+# keeps each location's prediction model between runs in MODEL_DIR, so nightly training only folds
+# in the days that became settled since the last run instead of retraining on the whole dataset.
+# New days are added as extra trees of the saved forest (warm start). The model is retrained on the
+# whole dataset when it has none saved, every FULL_RETRAIN_DAYS days, when it grows past MAX_TREES
+# trees, or when its error on the new days drifts DRIFT_THRESHOLD_DAYS above its error when trained.
+# Used by run_scraper.py's train stage
+
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import pandas as pd
+from sklearn.metrics import mean_absolute_error
+
+from predict_future_date import PREDICTION_LOCATIONS, TRAINING_WORKERS, add_gaps, fit_location, format_predictions, \
+    predict_food_days
+from training_data import load_training_data
+
+MODEL_DIR = os.getenv('MODEL_DIR', 'models')
+FULL_RETRAIN_DAYS = int(os.getenv('FULL_RETRAIN_DAYS', '7'))
+INCREMENT_TREES = int(os.getenv('INCREMENT_TREES', '10'))
+MAX_TREES = int(os.getenv('MAX_TREES', '150'))
+# fewer new gaps than this are left for the next run instead of fitting trees on them
+INCREMENT_MIN_GAPS = int(os.getenv('INCREMENT_MIN_GAPS', '50'))
+DRIFT_THRESHOLD_DAYS = float(os.getenv('DRIFT_THRESHOLD_DAYS', '1.0'))
+
+def compute_predictions_incremental(dataset_dir: str, settled_before: datetime, full_retrain: bool = False):
+    """ updates the saved model of each location in PREDICTION_LOCATIONS, in parallel on
+    TRAINING_WORKERS processes, and returns (dictionary of location code: predictions array formatted
+    like food, date1, date2, date3, dictionary of location code: summary of its training)
+
+    Rows from settled_before onwards may still change in later runs, so they update each food's
+    last appearance for predicting but are never trained on.
+
+    :param dataset_dir: from training_data.export_training_data
+    :param settled_before: first date that the scraper may still change
+    :param full_retrain: retrain every location on the whole dataset
+    """
+    tasks = [(location.value, dataset_dir, settled_before, full_retrain) for location in PREDICTION_LOCATIONS]
+    if TRAINING_WORKERS <= 1:
+        results = list(map(train_location, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=min(TRAINING_WORKERS, len(tasks))) as executor:
+            results = list(executor.map(train_location, tasks))
+
+    # locations without training data have no predictions
+    predictions = {location_code: predictions_array for (location_code, *_), (predictions_array, _) in zip(tasks, results)
+                   if predictions_array is not None}
+    summaries = {location_code: summary for (location_code, *_), (_, summary) in zip(tasks, results)}
+    return predictions, summaries
+
+def train_location(task: tuple):
+    """ brings one location's saved model up to date and returns (predictions array or None,
+    summary). Runs in a worker process of compute_predictions_incremental
+
+    :param task: (location_code, dataset_dir, settled_before, full_retrain)
+    """
+    location_code, dataset_dir, settled_before, full_retrain = task
+    state = load_model_state(location_code)
+    reason = get_full_retrain_reason(state, settled_before, full_retrain)
+
+    # read only the rows not yet folded into the model, unless retraining
+    since = None if reason else state['trained_through']
+    food_db = load_training_data(dataset_dir, since=since)
+    food_location_db = food_db.loc[food_db['Location'] == location_code, ['Recipe', 'Date']] \
+        .rename(columns={'Recipe': 'Food', 'Date': 'Date(Datetime)'})
+    settled_db = food_location_db[food_location_db['Date(Datetime)'] < settled_before]
+    unsettled_db = food_location_db[food_location_db['Date(Datetime)'] >= settled_before]
+    summary = {'mode': 'full' if reason else 'incremental', 'reason': reason, 'rows': len(settled_db)}
+
+    if reason:
+        if settled_db.empty:
+            return None, {**summary, 'mode': 'skipped', 'reason': 'no training data'}
+        state = train_full(settled_db, settled_before)
+        save_model_state(location_code, state)
+        foods = state['foods']
+    else:
+        new_gaps, foods = fold_rows(state['foods'], settled_db)
+        summary['gaps'] = len(new_gaps)
+        if len(new_gaps) >= INCREMENT_MIN_GAPS:
+            # retrain if the model no longer predicts the new gaps as well as when it was trained
+            mae = mean_absolute_error(new_gaps, state['model'].predict(new_gaps.reshape(-1, 1)))
+            if mae - state['mae'] > DRIFT_THRESHOLD_DAYS:
+                predictions_array, summary = train_location((location_code, dataset_dir, settled_before, True))
+                return predictions_array, {**summary, 'reason': f'drift: MAE {mae:.2f} from {state["mae"]:.2f} days'}
+            add_trees(state['model'], new_gaps)
+            state.update(foods=foods, trained_through=settled_before, updates=state['updates'] + 1)
+            save_model_state(location_code, state)
+        else:
+            # too few to fit trees on, train on them next time, but still predict from them
+            summary['mode'] = 'unchanged'
+
+    # predict from each food's latest appearance, including days that may still change
+    _, latest_foods = fold_rows(foods, unsettled_db)
+    if latest_foods.empty:
+        return None, summary
+    return format_predictions(predict_food_days(state['model'], latest_foods)), summary
+
+def get_full_retrain_reason(state: dict, settled_before: datetime, full_retrain: bool):
+    """ returns why a location's model should be retrained on the whole dataset, or None """
+    if full_retrain:
+        return 'requested'
+    if state is None:
+        return 'no saved model'
+    if settled_before < state['trained_through']:
+        return 'settled days changed'
+    if (settled_before - state['full_trained']).days >= FULL_RETRAIN_DAYS:
+        return 'scheduled'
+    if len(state['model'].estimators_) + INCREMENT_TREES > MAX_TREES:
+        return 'too many trees'
+    return None
+
+def train_full(settled_db: pd.DataFrame, settled_before: datetime):
+    """ returns model state trained on all of a location's settled rows
+
+    :param settled_db: location's 'Food' and 'Date(Datetime)' rows before settled_before
+    :param settled_before: first date that the scraper may still change
+    """
+    model, food_location_db = fit_location(settled_db.sort_values(['Food', 'Date(Datetime)'], kind='stable'))
+    return {'model': model, 'mae': model.evaluation_results_['MAE'], 'foods': get_latest(food_location_db),
+            'trained_through': settled_before, 'full_trained': settled_before, 'updates': 0}
+
+def fold_rows(foods: pd.DataFrame, food_location_db: pd.DataFrame):
+    """ returns (array of gaps that the new rows add, each food's latest appearance after them)
+
+    :param foods: each food's latest appearance, with columns 'Food', 'Date(Datetime)', and 'Gap'
+    :param food_location_db: new 'Food' and 'Date(Datetime)' rows, all later than foods
+    """
+    combined = add_gaps(pd.concat([foods, food_location_db.assign(Gap=float('nan'))], ignore_index=True)
+                        .sort_values(['Food', 'Date(Datetime)'], kind='stable'))
+    # the earlier appearance of each food keeps its own gap
+    is_new = combined.index >= len(foods)
+    combined.loc[~is_new, 'Gap'] = foods['Gap'].reindex(combined.index[~is_new]).to_numpy()
+    new_gaps = combined.loc[is_new, 'Gap'].dropna().to_numpy()
+    return new_gaps, get_latest(combined)
+
+def get_latest(food_location_db: pd.DataFrame):
+    """ returns each food's last row, with columns 'Food', 'Date(Datetime)', and 'Gap' """
+    return food_location_db.groupby('Food').tail(1)[['Food', 'Date(Datetime)', 'Gap']].reset_index(drop=True)
+
+def add_trees(model, new_gaps):
+    """ fits INCREMENT_TREES more trees of the forest on only the new gaps, in the same way
+    make_food_model fits the first trees """
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + INCREMENT_TREES)
+    model.fit(new_gaps.reshape(-1, 1), new_gaps)
+
+def get_model_path(location_code: int):
+    """ returns path of a location's saved model state """
+    return os.path.join(MODEL_DIR, f'location_{location_code}.pkl')
+
+def load_model_state(location_code: int):
+    """ returns a location's saved model state, or None """
+    path = get_model_path(location_code)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+def save_model_state(location_code: int, state: dict):
+    """ saves a location's model state, replacing the previous one only once written """
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    path = get_model_path(location_code)
+    with open(path + '.tmp', 'wb') as file:
+        pickle.dump(state, file)
+    os.replace(path + '.tmp', path)
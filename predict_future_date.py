@@ -8,6 +8,8 @@ Original file is located at
 """
 # print ("predict_future date: start import")
 # TODO Remove imporats
+import os
+import numpy as np
 import pandas as pd
 import datetime as dt
 from sklearn.model_selection import train_test_split
@@ -15,15 +17,19 @@ from sklearn import model_selection
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 
-from searchdb import LocationCodesNum, save_predictions_to_db, NUM_PREDICTIONS
+from searchdb import NUM_PREDICTIONS, PREDICTION_LOCATIONS
 
 # print ("end import")
 
+# Locations in PREDICTION_LOCATIONS are trained each in its own process
+TRAINING_WORKERS = int(os.getenv('TRAINING_WORKERS', str(min(len(PREDICTION_LOCATIONS), os.cpu_count() or 1))))
+MODEL_SEED = int(os.getenv('MODEL_SEED', '42'))
+
 # TODO header comments and DOUBLE CHECK in line comments
 def make_food_model (food_dining_db):
     """ 
-    Trains the model for this dining hall
-    :food_dining_db: the dataframe of a certain dining hall (food_kins_db, food_j2_db, OR food_jcl_db)
+    Trains the model for this dining hall, seeded with MODEL_SEED so runs are repeatable
+    :food_dining_db: the dataframe of a certain dining hall, from fit_location
     """
     # Removes NaNs
     food_dining_db = food_dining_db.dropna(subset=['Gap'])
@@ -34,8 +40,8 @@ def make_food_model (food_dining_db):
     y_dining = food_dining_db['Gap']
 
     # Trains the data
-    model = RandomForestRegressor(n_estimators=50, random_state=42)
-    X_train, X_test, y_train, y_test = train_test_split(gaps_dining, y_dining, test_size=0.2, random_state=42)
+    model = RandomForestRegressor(n_estimators=50, random_state=MODEL_SEED)
+    X_train, X_test, y_train, y_test = train_test_split(gaps_dining, y_dining, test_size=0.2, random_state=MODEL_SEED)
     model.fit(X_train, y_train)
 
     # Makes predictions to test the model
@@ -46,119 +52,65 @@ def make_food_model (food_dining_db):
     mse = mean_squared_error(y_test, y_test_pred)  # Mean Squared Error
     r2 = r2_score(y_test, y_test_pred)  # R² Score
 
-    # Store evaluation metrics
+    # Store evaluation metrics, kept on the model for detecting drift in incremental_training
     evaluation_results = {'MAE': mae, 'MSE': mse, 'R²': r2}
-    # TODO for testing purposes
+    model.evaluation_results_ = evaluation_results
 
     return model
 
 def predict_food_days(model, food_dining_db):
     """ 
-    Makes predictions for future 
+    Makes predictions for future, predicting the next gap of every food in one call per step
     :model: from make_food_model
-    :food_dining_db: the dataframe of a certain dining hall (food_kins_db, food_j2_db, OR food_jcl_db)
+    :food_dining_db: the dataframe of a certain dining hall, from add_gaps
+    """
+    # Last observed date and gap of each food, in the order of groupby
+    last_rows = food_dining_db.groupby('Food').tail(1).set_index('Food').sort_index()
+    last_dates = last_rows['Date(Datetime)'].to_numpy(dtype='datetime64[ns]')
+    last_gaps = last_rows['Gap'].to_numpy(dtype=float)
+    predictions = np.empty((NUM_PREDICTIONS, len(last_rows)), dtype='datetime64[ns]')
+
+    # Make future predictions for all foods
+    if len(last_rows):
+        for step in range(NUM_PREDICTIONS):
+            predicted_gaps = model.predict(last_gaps.reshape(-1, 1))  # Predict next gap of each food based on its last gap
+            last_dates = last_dates + pd.to_timedelta(predicted_gaps, unit='D').to_numpy()  # Add predicted gaps to last dates
+            predictions[step] = last_dates
+            last_gaps = predicted_gaps  # Update last gaps to the predicted gaps for the next iteration
+
+    return pd.DataFrame(predictions, columns=last_rows.index.rename(None))
+
+
+def fit_location (food_location_db):
+    """ 
+    Trains the model for one location and returns (model, the rows with gaps from add_gaps).
+    Used by incremental_training for each full retrain
+    :food_location_db: dataframe of a location's 'Food' and 'Date(Datetime)' rows, sorted by food and date
+    """
+    food_location_db = add_gaps(food_location_db)
+
+    # Train the model
+    return make_food_model(food_location_db), food_location_db
+
+def add_gaps (food_location_db):
+    """ 
+    Returns the dataframe with each food counted once per day, and a "Gap" column of days since
+    the food's previous appearance
+    :food_location_db: dataframe of a location's 'Food' and 'Date(Datetime)' rows, sorted by food and date
+    """
+    food_location_db = food_location_db.drop_duplicates(subset=['Date(Datetime)', 'Food'], keep='first')
+    return food_location_db.assign(Gap=food_location_db.groupby('Food')['Date(Datetime)'].diff().dt.days)
+
+def format_predictions (predicted_food_days):
+    """ 
+    Returns predictions array formatted like food, date1, date2, date3
+    :predicted_food_days: from predict_food_days
     """
-    food_groups = food_dining_db.groupby('Food')
-    predictions = {}
-
-    # Make future predictions for each food
-    for food, group in food_groups:
-        # Predict the next `x` gaps for this specific food
-        predicted_dates = [group['Date(Datetime)'].iloc[-1]]  # Use the last date for this specific food group
-        last_gap = group['Gap'].iloc[-1]  # The last observed gap for this food
-
-        for _ in range(NUM_PREDICTIONS):
-            predicted_gap = model.predict([[last_gap]])  # Predict next gap based on the last gap
-            next_date = predicted_dates[-1] + pd.Timedelta(days=predicted_gap[0])  # Add predicted gap to last date
-            predicted_dates.append(next_date)  # Append the predicted date
-            last_gap = predicted_gap[0]  # Update last_gap to the predicted gap for the next iteration
-
-        predictions[food] = predicted_dates[1:]  # Return the predicted dates (excluding the first one, which is the last known date)
-    
-    return pd.DataFrame.from_dict(predictions)
-
-
-def make_predictions (cursor, csv_file_name):
-    # Load the dataset from csv
-    names = ['Food', 'Date(String)', 'Breakfast', 'Lunch', 'Dinner', 'Kins', "J2", "JCL"]
-    food_db = pd.read_csv(csv_file_name, header=None)
-    food_db = food_db[1:]   # drop first row; it doesn't contain any data
-    food_db.columns = names
-
-    # Convert date strings into datetime objects
-    food_db['Date(Datetime)'] = pd.to_datetime(food_db["Date(String)"])
-
-    # Drop date string column
-    food_appearance_db = food_db.drop(columns=['Date(String)'])
-
-    # Creates a dataframe for each dining hall AND adds "Gap" column for time differences
-    #Kins
-    food_kins_db = food_appearance_db[food_appearance_db["Kins"] == 1].drop(columns=['J2', 'JCL'])
-    food_kins_db = food_kins_db.drop_duplicates(subset=['Date(Datetime)', 'Food'], keep='first')
-    food_kins_db["Gap"] = food_kins_db.groupby('Food')['Date(Datetime)'].diff().dt.days
-    #J2
-    food_j2_db = food_appearance_db[food_appearance_db["J2"] == 1].drop(columns=['Kins', 'JCL'])
-    food_j2_db = food_j2_db.drop_duplicates(subset=['Date(Datetime)', 'Food'], keep='first')
-    food_j2_db["Gap"] = food_j2_db.groupby('Food')['Date(Datetime)'].diff().dt.days
-    #JCL
-    food_jcl_db = food_appearance_db[food_appearance_db["JCL"] == 1].drop(columns=['J2', 'Kins'])
-    food_jcl_db = food_jcl_db.drop_duplicates(subset=['Date(Datetime)', 'Food'], keep='first')
-    food_jcl_db["Gap"] = food_jcl_db.groupby('Food')['Date(Datetime)'].diff().dt.days
-
-    # Train the models and get predictions for each dining hall
-    kins_model = make_food_model(food_kins_db)
-    kins_predicted_future_dates = predict_food_days(kins_model, food_kins_db).transpose()
-
-    j2_model = make_food_model(food_j2_db)
-    j2_predicted_future_dates = predict_food_days(j2_model, food_j2_db).transpose()
-
-    jcl_model = make_food_model(food_jcl_db)
-    jcl_predicted_future_dates = predict_food_days(jcl_model, food_jcl_db).transpose()
-
-    # FORMAT: Turn 'food names' from index into a new column
-    kins_predicted_food_dates_reset = kins_predicted_future_dates.reset_index()
-    j2_predicted_food_dates_reset = j2_predicted_future_dates.reset_index()
-    jcl_predicted_food_dates_reset = jcl_predicted_future_dates.reset_index()
-
-    # FORMAT: Rename the food names column from 'index' to 'Food Name'
-    # Result is a table in this format for each dining hall: "Food Name", 0, 1 , 2
-    kins_predicted_dates = kins_predicted_food_dates_reset.rename(columns={'index': 'Food Name'})
-    j2_predicted_dates = j2_predicted_food_dates_reset.rename(columns={'index': 'Food Name'})
-    jcl_predicted_dates = jcl_predicted_food_dates_reset.rename(columns={'index': 'Food Name'})
-
-    # Save these predictions into the database:
-    ### KINS ###
-    # Convert all columns with date values (except 'Food Name') to datetime objects
-    for col in kins_predicted_dates.columns[1:]:  # Skip 'Food Name'
-        kins_predicted_dates[col] = kins_predicted_dates[col].dt.date  # Convert to date object
-    kins_predicted_food_dates_reset = kins_predicted_future_dates.reset_index() # Resetting the index and assigning it as a new column
-    kins_predicted_dates = kins_predicted_food_dates_reset.rename(columns={'index': 'Food Name'}) # Rename the food string column from 'index' to 'Food Name'
-    for col in kins_predicted_dates.columns[1:]:  # Skip 'Food Name'     # Convert all columns with date values (except 'Food Name') to date objects
-        kins_predicted_dates[col] = kins_predicted_dates[col].dt.date
-    kins_predicted_dates_array = kins_predicted_dates.to_numpy()     # Convert the DataFrame to a NumPy array
-    save_predictions_to_db (kins_predicted_dates_array, cursor, LocationCodesNum.KINS.value)     # Save predictions
-
-    ### J2 ###
-    # Convert all columns with date values (except 'Food Name') to datetime objects
-    for col in j2_predicted_dates.columns[1:]:  # Skip 'Food Name'
-        j2_predicted_dates[col] = j2_predicted_dates[col].dt.date  # Convert to date object
-    j2_predicted_food_dates_reset = j2_predicted_future_dates.reset_index() # Resetting the index and assigning it as a new column
-    j2_predicted_dates = j2_predicted_food_dates_reset.rename(columns={'index': 'Food Name'}) # Rename the food string column from 'index' to 'Food Name'
-    for col in j2_predicted_dates.columns[1:]:  # Skip 'Food Name'     # Convert all columns with date values (except 'Food Name') to date objects
-        j2_predicted_dates[col] = j2_predicted_dates[col].dt.date
-    j2_predicted_dates_array = j2_predicted_dates.to_numpy()     # Convert the DataFrame to a NumPy array
-    save_predictions_to_db (j2_predicted_dates_array, cursor, LocationCodesNum.J2.value)     # Save predictions
-
-    ### JCL ###
-    # Convert all columns with date values (except 'Food Name') to datetime objects
-    for col in jcl_predicted_dates.columns[1:]:  # Skip 'Food Name'
-        jcl_predicted_dates[col] = jcl_predicted_dates[col].dt.date  # Convert to date object
-    jcl_predicted_food_dates_reset = jcl_predicted_future_dates.reset_index() # Resetting the index and assigning it as a new column
-    jcl_predicted_dates = jcl_predicted_food_dates_reset.rename(columns={'index': 'Food Name'}) # Rename the food string column from 'index' to 'Food Name'
-    for col in jcl_predicted_dates.columns[1:]:  # Skip 'Food Name'     # Convert all columns with date values (except 'Food Name') to date objects
-        jcl_predicted_dates[col] = jcl_predicted_dates[col].dt.date
-    jcl_predicted_dates_array = jcl_predicted_dates.to_numpy()     # Convert the DataFrame to a NumPy array
-    save_predictions_to_db (jcl_predicted_dates_array, cursor, LocationCodesNum.JCL.value)     # Save predictions
-
-    # Done
-    print ("Done making and writing predictions") # not yet committed, though!
+    # FORMAT: Turn 'food names' from index into a new column named 'Food Name'
+    # Result is a table in this format: "Food Name", 0, 1 , 2
+    predicted_dates = predicted_food_days.transpose().reset_index().rename(columns={'index': 'Food Name'})
+
+    # Convert all columns with date values (except 'Food Name') to date objects
+    for col in predicted_dates.columns[1:]:
+        predicted_dates[col] = predicted_dates[col].dt.date
+    return predicted_dates.to_numpy()     # Convert the DataFrame to a NumPy array
@@ -0,0 +1,126 @@
+# replica.py
+# keeps a local SQLite copy of the menu tables, predictions and their generations, and scrape log so
+# the web app can read without going over the network. Synced by run_scraper.py after it commits, or manually:
+#   python replica.py (reads Azure SQL connection details from environment variables)
+# The web app reads from the replica when DB_BACKEND=sqlite and DB_REPLICA_PATH are set
+
+import os
+import sqlite3
+import pyodbc
+from searchdb import get_replica_connection, get_server_connection, get_month_start, get_table_month, \
+    get_today, menu_catalog, GENERATION_TABLE_NAME, PREDICTION_TABLE_NAME, REPLICA_DEFAULT_PATH, SCRAPE_LOG_TABLE_NAME
+
+# version of the replica's tables, in PRAGMA user_version. 1 removed duplicate menu rows that
+# are only copied once, 2 made Recipe match ignoring case in them, like Azure SQL
+REPLICA_VERSION = 2
+
+# columns copied from each table, with their SQLite types
+# Recipe ignores case, since the server's collation does and search_cache keys are lowercase
+MENU_COLUMNS = ['Recipe varchar(65) COLLATE NOCASE', '[Date] timestamp', 'Mealtime int', '[Location] int']
+PREDICTION_COLUMNS = ['Recipe varchar(65) COLLATE NOCASE', '[Date] timestamp', '[Location] int', 'Generation int']
+GENERATION_COLUMNS = ['Generation int', 'Published timestamp', 'NumRows int']
+SCRAPE_LOG_COLUMNS = ['Completed timestamp']
+
+def sync_replica(cursor: pyodbc.Cursor, path: str):
+    """ copies menu tables, predictions, and scrape log from the database into the SQLite
+    replica at path, in one transaction so readers never see a partial sync
+
+    Monthly tables from before this month don't change, so they are only copied once.
+
+    :param cursor: cursor to Azure SQL database, only reads
+    :param path: file path of replica, created if missing
+    """
+    replica = get_replica_connection(path)
+    replica.isolation_level = None  # transaction is managed below
+    replica_cursor = replica.cursor()
+
+    # find which monthly tables to copy
+    replica_tables = {row.name for row in replica_cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    this_month = get_month_start(get_today())
+    menu_tables = sorted(table for table in menu_catalog.load(cursor)
+                         if table not in replica_tables or get_table_month(table) >= this_month)
+
+    # read everything first, keeping the write transaction short
+    copies = [(table, MENU_COLUMNS, read_table(cursor, table, MENU_COLUMNS)) for table in menu_tables]
+    copies.append((PREDICTION_TABLE_NAME, PREDICTION_COLUMNS,
+                   read_table(cursor, PREDICTION_TABLE_NAME, PREDICTION_COLUMNS)))
+    copies.append((GENERATION_TABLE_NAME, GENERATION_COLUMNS,
+                   read_table(cursor, GENERATION_TABLE_NAME, GENERATION_COLUMNS)))
+    copies.append((SCRAPE_LOG_TABLE_NAME, SCRAPE_LOG_COLUMNS,
+                   read_table(cursor, SCRAPE_LOG_TABLE_NAME, SCRAPE_LOG_COLUMNS)))
+
+    # replace each table's rows
+    try:
+        replica_cursor.execute('BEGIN IMMEDIATE')
+        # update past months, which are not copied again
+        version = replica_cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version < REPLICA_VERSION:
+            past_tables = [table for table in sorted(replica_tables - set(menu_tables)) if get_table_month(table) is not None]
+            for table in past_tables:
+                # remove duplicates copied before the server's were removed
+                if version < 1:
+                    remove_duplicate_replica_rows(replica_cursor, table)
+                # recreate with Recipe ignoring case
+                if version < 2:
+                    rebuild_replica_table(replica_cursor, table, MENU_COLUMNS)
+            replica_cursor.execute(f'PRAGMA user_version = {REPLICA_VERSION}')
+        for table, columns, rows in copies:
+            write_table(replica_cursor, table, columns, rows)
+        replica_cursor.execute('COMMIT')
+    except sqlite3.Error:
+        replica_cursor.execute('ROLLBACK')
+        raise
+    finally:
+        replica.close()
+
+    print(f'sync_replica completed: copied {len(copies)} tables into {path}')
+
+def remove_duplicate_replica_rows(replica_cursor: sqlite3.Cursor, table: str):
+    """ deletes repeats of the same recipe, date, mealtime, and location from a replica menu
+    table, like searchdb.remove_duplicate_rows. DOES NOT COMMIT """
+    replica_cursor.execute(f'DELETE FROM {table} WHERE rowid NOT IN '\
+                           f'(SELECT MIN(rowid) FROM {table} GROUP BY Recipe, [Date], Mealtime, [Location])')
+
+def rebuild_replica_table(replica_cursor: sqlite3.Cursor, table: str, columns: list):
+    """ recreates a replica table with the current column definitions, keeping its rows. DOES NOT COMMIT """
+    column_names = ', '.join(column.split()[0] for column in columns)
+    rows = replica_cursor.execute(f'SELECT {column_names} FROM {table}').fetchall()
+    write_table(replica_cursor, table, columns, rows)
+
+def read_table(cursor: pyodbc.Cursor, table: str, columns: list):
+    """ returns all rows of a table as a list of tuples
+
+    :param cursor: cursor to Azure SQL database
+    :param table: name of table
+    :param columns: column definitions, from MENU_COLUMNS etc.
+    """
+    column_names = ', '.join(column.split()[0] for column in columns)
+    cursor.execute(f'SELECT {column_names} FROM {table}')
+    return [tuple(row) for row in cursor.fetchall()]
+
+def write_table(replica_cursor: sqlite3.Cursor, table: str, columns: list, rows: list):
+    """ replaces rows of a replica table, creating it if missing. DOES NOT COMMIT
+
+    :param replica_cursor: cursor to the SQLite replica
+    :param table: name of table
+    :param columns: column definitions, from MENU_COLUMNS etc.
+    :param rows: list of tuples in the order of columns
+    """
+    # recreate tables copied before their columns changed
+    create_table = f'CREATE TABLE {table} ({", ".join(columns)})'
+    existing = replica_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()
+    if existing is not None and existing.sql != create_table:
+        replica_cursor.execute(f'DROP TABLE {table}')
+        existing = None
+    if existing is None:
+        replica_cursor.execute(create_table)
+    if '[Date] timestamp' in columns:
+        replica_cursor.execute(f'CREATE INDEX IF NOT EXISTS IX_{table}_Recipe ON {table} (Recipe, [Date])')
+    replica_cursor.execute(f'DELETE FROM {table}')
+    placeholders = ', '.join('?' for _ in columns)
+    replica_cursor.executemany(f'INSERT INTO {table} VALUES ({placeholders})', rows)
+
+if __name__ == '__main__':
+    connection = get_server_connection()
+    sync_replica(connection.cursor(), os.getenv('DB_REPLICA_PATH', REPLICA_DEFAULT_PATH))
+    connection.close()
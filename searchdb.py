@@ -1,19 +1,27 @@
 # searchdb.py
 # provides methods to search database for availability of foods from UT Austin dining halls
 # assumes connection details in environment variables
+# reads from Azure SQL, or from a local SQLite replica (see replica.py) if DB_BACKEND is 'sqlite'
 # TODO change print statements to logging statements
 
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache
+import bisect
+import heapq
+import json
+import sqlite3
+import threading
+import time
 import pyodbc
 import pytz
 import os
-import pandas as pd
 
 # mapping from database codes to strings
 NUM_PREDICTIONS = 3 # Number of dates to predict for each food 
 MEALTIME_CODES = ['ERROR', 'Breakfast', 'Lunch', 'Dinner']
-ENTIRE_DATABASE_CSV_FILENAME = 'entire_database.csv'
 class LocationCodesNum(Enum):
     ERR = 0
     KINS = 1
@@ -59,20 +67,39 @@ def load_menu_home(food_name: str, filters: str):
 
     # validate filters
     filters = validate_filters(filters, False)
+
+    # Use cached results if this search was already made today
+    cache_key = search_cache.make_key('home', food_name, filters)
+    loaded_menu = search_cache.get(cache_key)
+    if loaded_menu is not None:
+        return loaded_menu
+
+    # results from a table catalog still loading may miss tables, so they aren't cached
+    cacheable = menu_catalog.is_current()
+
+    # Find matching recipes in memory. None if the index is not ready yet or is reloading
+    # after a new scrape, then the database matches them
+    recipe_names = recipe_index.match(food_name)
+    if recipe_names == []:
+        if cacheable and menu_catalog.is_current():
+            search_cache.put(cache_key, [], 0)
+        return []
     
-    # Connect to database
-    connection = get_connection()
-    cursor = connection.cursor()
+    # Borrow a connection from the pool
+    with borrow_connection() as connection:
+        cursor = connection.cursor()
 
-    # Get the SQL query
-    query = get_filtered_query(filters, food_name, False, cursor)
+        # Get the SQL query
+        query, params = get_filtered_query(filters, food_name, False, recipe_names)
 
-    # Execute query
-    print(f'load_menu_home searching for {food_name} with filters {filters} and query {query}')
-    cursor.execute(query)
+        # Execute query
+        print(f'load_menu_home searching for {food_name} with filters {filters} and query {query}')
+        rows = []
+        if query is not None:
+            cursor.execute(query, params)
 
-    # Fetch results of query
-    rows = cursor.fetchall()
+            # Fetch results of query
+            rows = cursor.fetchall()
 
     # Extract data and store into a list, in the home page format
     loaded_menu = []
@@ -83,10 +110,10 @@ def load_menu_home(food_name: str, filters: str):
         date = 'Today' if date == today else ('Tomorrow' if date == tomorrow else f'{date.strftime("%A")}')
         loaded_menu.append([row.Recipe, date, MEALTIME_CODES[row.Mealtime], LOCATION_CODES[row.Location]])
 
-    # Close the connection
-    connection.close()
     print('load_menu_home completed sucessfully')
     
+    if cacheable and menu_catalog.is_current():
+        search_cache.put(cache_key, loaded_menu, len(loaded_menu))
     return loaded_menu
 
 def load_menu_details(food_name: str, filters: str):
@@ -99,19 +126,30 @@ def load_menu_details(food_name: str, filters: str):
     # validate filters
     filters = validate_filters(filters, True)
 
-    # Connect to database
-    connection = get_connection()
-    cursor = connection.cursor()
+    # Use cached results if this search was already made today
+    cache_key = search_cache.make_key('details', food_name, filters)
+    loaded_details = search_cache.get(cache_key)
+    if loaded_details is not None:
+        return loaded_details
+
+    # results from a table catalog still loading may miss tables, so they aren't cached
+    cacheable = menu_catalog.is_current()
 
-    # Get the SQL query
-    query = get_filtered_query(filters, food_name, True, cursor)
+    # Borrow a connection from the pool
+    with borrow_connection() as connection:
+        cursor = connection.cursor()
 
-    # Execute query
-    print(f'load_menu_details searching for {food_name} with filters {filters} and query {query}')
-    cursor.execute(query)
+        # Get the SQL query
+        query, params = get_filtered_query(filters, food_name, True)
 
-    # Fetch results of query
-    rows = cursor.fetchall()
+        # Execute query
+        print(f'load_menu_details searching for {food_name} with filters {filters} and query {query}')
+        rows = []
+        if query is not None:
+            cursor.execute(query, params)
+
+            # Fetch results of query
+            rows = cursor.fetchall()
 
     # Extract data and store into a list in the details page format
     loaded_details = []
@@ -119,14 +157,69 @@ def load_menu_details(food_name: str, filters: str):
         date = row.Date.strftime("%d %B '%y").lstrip('0')
         loaded_details.append([date, MEALTIME_CODES[row.Mealtime], LOCATION_CODES[row.Location]])
 
-    # Close the connection
-    connection.close()
     print('load_menu_details completed sucessfully')
     
+    if cacheable and menu_catalog.is_current():
+        search_cache.put(cache_key, loaded_details, len(loaded_details))
     return loaded_details
 
+def load_food_details(food_name: str, filters: str):
+    """ load future availability and past availability for single food from database, and its
+    predictions from prediction_map, each formatted for the details page
+
+    Returns (future_menu, past_menu, predictions). Rows from today onwards are future.
+
+    :param food_name: name of food to search
+    :param filters: string representing filter settings. time filter is ignored
+    """
+
+    # validate filters
+    filters = validate_filters(filters, True)
+
+    # Use cached results if this search was already made today
+    cache_key = search_cache.make_key('food_details', food_name, filters)
+    menu_details = search_cache.get(cache_key)
+    # results from a table catalog still loading may miss tables, so they aren't cached
+    cacheable = menu_catalog.is_current()
+
+    # Predictions are kept in memory, without a round trip. Read after the cache, which
+    # invalidates them when a new scrape has completed
+    predictions = prediction_map.get(food_name)
+    if menu_details is not None:
+        return (*menu_details, predictions)
+
+    # Get the SQL query for every availability of this food
+    templates = get_query_templates(get_today(), menu_catalog.get())
+    menu_query, slots = templates.get(None, filters, 'exact')
+    rows = []
+    if menu_query is not None:
+        # Borrow a connection from the pool
+        with borrow_connection() as connection:
+            cursor = connection.cursor()
+            print(f'load_food_details searching for {food_name} with filters {filters}')
+            cursor.execute(menu_query, bind_params(slots, food_name, None, None))
+            rows = cursor.fetchall()
+
+    # Split into future and past, then store into lists in the details page format
+    future_menu = []
+    past_menu = []
+    today = get_today()
+    for row in rows:
+        date = row.Date.strftime("%d %B '%y").lstrip('0')
+        entry = [date, MEALTIME_CODES[row.Mealtime], LOCATION_CODES[row.Location]]
+        (future_menu if row.Date >= today else past_menu).append(entry)
+
+    print('load_food_details completed sucessfully')
+
+    menu_details = (future_menu, past_menu)
+    if cacheable and menu_catalog.is_current():
+        search_cache.put(cache_key, menu_details, len(future_menu) + len(past_menu))
+    return (*menu_details, predictions)
+
+@lru_cache(maxsize=256)
 def validate_filters(filters_str: str, is_details_page: bool):
     """ checks that filters_str is valid and returns a corrected string otherwise 
+    (results are cached since only a few filter strings are used)
     
     :param filters_str: the filter string to check
     :param is_details_page: if current route is /details
@@ -153,8 +246,19 @@ def validate_filters(filters_str: str, is_details_page: bool):
     # return as string
     return ''.join(filters)
 
+def use_replica():
+    """ Returns true if reads use the local SQLite replica instead of Azure SQL """
+    return os.getenv('DB_BACKEND', 'mssql') == 'sqlite'
+
 def get_connection():
-    """ returns a pyodbc connection to the database from environment variables """
+    """ returns a connection to the database from environment variables: the local SQLite
+    replica if use_replica(), otherwise Azure SQL """
+    if use_replica():
+        return get_replica_connection(os.getenv('DB_REPLICA_PATH', REPLICA_DEFAULT_PATH))
+    return get_server_connection()
+
+def get_server_connection():
+    """ returns a pyodbc connection to Azure SQL from environment variables """
     
     # get database connection information
     DB_SERVER_NAME = os.getenv('DB_SERVER_NAME')
@@ -170,32 +274,337 @@ def get_connection():
     # return connection
     return pyodbc.connect(connection_string)
 
-# TODO shorten function (142 lines, yikes!)
-def get_filtered_query(filters: str, food_name: str, exact_match: bool, 
-                       cursor: pyodbc.Cursor):
-    """ returns SQL query string for database using filters 
+REPLICA_DEFAULT_PATH = 'menu_replica.db'
+# columns read from the replica as datetime objects, like pyodbc does
+REPLICA_DATE_COLUMNS = {'Date', 'LastDate', 'Completed'}
+sqlite3.register_adapter(datetime, lambda date: date.isoformat(' '))
+
+@lru_cache(maxsize=64)
+def _replica_row_type(columns: tuple):
+    return namedtuple('ReplicaRow', columns)
+
+def _replica_row_factory(cursor: sqlite3.Cursor, values: tuple):
+    """ returns SQLite rows with attribute access and datetime columns, like pyodbc rows """
+    columns = tuple(column[0] for column in cursor.description)
+    values = [datetime.fromisoformat(value) if column in REPLICA_DATE_COLUMNS and isinstance(value, str) 
+              else value for column, value in zip(columns, values)]
+    return _replica_row_type(columns)(*values)
+
+def get_replica_connection(path: str):
+    """ returns a sqlite3 connection to the local replica at path, created if missing
+
+    The connection can be used from any thread, one at a time (ConnectionPool ensures this).
+    """
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.row_factory = _replica_row_factory
+    # let readers keep reading while the replica is synced
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+class ConnectionPool:
+    """ thread-safe pool of reusable database connections
+
+    Connections are opened on demand up to max_size and handed back to the pool when the
+    borrow() block exits, so Flask worker threads share a few open connections instead of
+    paying for a new encrypted login on every query. Connections idle for longer than
+    idle_timeout seconds are closed, and connections idle for longer than check_after
+    seconds are health checked before they are handed out again.
+    """
+
+    def __init__(self, connect, max_size: int, idle_timeout: float, check_after: float,
+                 checkout_timeout: float):
+        """
+        :param connect: function that opens and returns a new connection
+        :param max_size: maximum number of connections open at once (borrowed + idle)
+        :param idle_timeout: seconds an unused connection is kept before it is closed
+        :param check_after: seconds an unused connection may sit before it is health checked
+        :param checkout_timeout: seconds to wait for a free connection before giving up
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.checkout_timeout = checkout_timeout
+        self._idle = []  # stack of [connection, time returned], most recently used last
+        self._num_open = 0  # borrowed and idle connections
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def borrow(self):
+        """ yields a connection, returning it to the pool afterwards. DOES NOT COMMIT WRITES """
+        connection = self._checkout()
+        try:
+            yield connection
+        except BaseException:
+            # connection may be in a bad state, do not reuse it
+            self._discard(connection)
+            raise
+        self._checkin(connection)
+
+    def close_all(self):
+        """ closes every idle connection. borrowed connections are closed when returned """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._num_open -= len(idle)
+            self._condition.notify_all()
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _checkout(self):
+        """ returns a healthy connection, waiting up to checkout_timeout if the pool is full """
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._condition:
+                expired = self._evict_idle()
+                while not self._idle and self._num_open >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f'No database connection available after {self.checkout_timeout}s')
+                    self._condition.wait(remaining)
+                    expired += self._evict_idle()
+
+                if self._idle:
+                    connection, returned_at = self._idle.pop()
+                else:
+                    # reserve a slot, then open the connection outside of the lock
+                    connection, returned_at = None, None
+                    self._num_open += 1
+
+            for old_connection in expired:
+                self._close(old_connection)
+
+            if connection is None:
+                try:
+                    return self.connect()
+                except BaseException:
+                    self._release_slot()
+                    raise
+
+            if time.monotonic() - returned_at < self.check_after or self._is_healthy(connection):
+                return connection
+            # stale connection (e.g. dropped by the server), replace it and try again
+            self._discard(connection)
+
+    def _checkin(self, connection):
+        """ returns a borrowed connection to the pool """
+        try:
+            # end any transaction left open by the borrower
+            connection.rollback()
+        except Exception:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append([connection, time.monotonic()])
+            self._condition.notify()
+
+    def _discard(self, connection):
+        """ closes a borrowed connection and frees its slot """
+        self._close(connection)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._condition:
+            self._num_open -= 1
+            self._condition.notify()
+
+    def _evict_idle(self):
+        """ removes and returns connections idle longer than idle_timeout. call with lock held """
+        cutoff = time.monotonic() - self.idle_timeout
+        # least recently used connections are at the bottom of the stack
+        num_expired = 0
+        while num_expired < len(self._idle) and self._idle[num_expired][1] < cutoff:
+            num_expired += 1
+        expired = [connection for connection, _ in self._idle[:num_expired]]
+        del self._idle[:num_expired]
+        self._num_open -= num_expired
+        return expired
+
+    @staticmethod
+    def _is_healthy(connection):
+        """ Returns true if connection can still reach the database """
+        try:
+            connection.cursor().execute('SELECT 1').fetchall()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+_pool = None
+_pool_lock = threading.Lock()
+def get_pool() -> ConnectionPool:
+    """ returns the shared connection pool, sized from environment variables """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(get_connection,
+                                   max_size=int(os.getenv('DB_POOL_SIZE', '5')),
+                                   idle_timeout=float(os.getenv('DB_POOL_IDLE_TIMEOUT', '600')),
+                                   check_after=float(os.getenv('DB_POOL_CHECK_AFTER', '30')),
+                                   checkout_timeout=float(os.getenv('DB_POOL_CHECKOUT_TIMEOUT', '30')))
+        return _pool
+
+def borrow_connection():
+    """ borrows a connection from the shared pool, for use in a with statement """
+    return get_pool().borrow()
+
+SCRAPE_LOG_TABLE_NAME = 'scrape_log'
+class SearchCache:
+    """ thread-safe LRU cache of search results
+
+    Menus only change when the scraper runs, so results are kept until Austin's midnight
+    (keys include get_today()) or until the scraper logs a completed run in
+    SCRAPE_LOG_TABLE_NAME, checked at most every marker_interval seconds. The total number
+    of cached rows is limited to max_rows, with empty results counting as one row; least
+    recently used results are evicted first.
+    """
+
+    def __init__(self, max_rows: int, marker_interval: float):
+        """
+        :param max_rows: maximum number of result rows kept across all cached searches
+        :param marker_interval: seconds between checks for a new completed scrape
+        """
+        self.max_rows = max_rows
+        self.marker_interval = marker_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: [value, number of rows], least recently used first
+        self._num_rows = 0
+        self._today = None
+        self._marker = None
+        self._marker_checked = None  # time.monotonic() of last marker check
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(kind: str, food_name: str, filters: str):
+        """ returns cache key for a search. searches are case insensitive, like the database
+
+        :param kind: name of the search, such as 'home'
+        :param food_name: name of food searched
+        :param filters: validated filters string
+        """
+        return (kind, food_name.lower(), filters, get_today())
+
+    def get(self, key):
+        """ returns cached value for key, or None if not cached """
+        self._expire()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, num_rows: int):
+        """ caches value for key
+
+        :param num_rows: number of result rows in value, counted towards max_rows. Every
+            result counts as at least one row, so empty results are evicted too
+        """
+        num_rows = max(num_rows, 1)
+        if num_rows > self.max_rows:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._num_rows -= self._entries.pop(key)[1]
+            self._entries[key] = [value, num_rows]
+            self._num_rows += num_rows
+
+            # evict least recently used results
+            while self._num_rows > self.max_rows:
+                _, (_, evicted_rows) = self._entries.popitem(last=False)
+                self._num_rows -= evicted_rows
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_rows = 0
+
+    def stats(self):
+        """ returns dictionary of cache counters """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 
+                    'rows': self._num_rows}
+
+    def _expire(self):
+        """ clears the cache if the day has changed or a new scrape has completed """
+        today = get_today()
+        if today != self._today:
+            self._today = today
+            self.clear()
+
+        now = time.monotonic()
+        if self._marker_checked is not None and now - self._marker_checked < self.marker_interval:
+            return
+        self._marker_checked = now
+        marker = get_scrape_marker()
+        if marker != self._marker:
+            self._marker = marker
+            self.clear()
+            # the scraper may have created a new monthly table and added new recipes
+            menu_catalog.invalidate()
+            recipe_index.invalidate()
+            # and published a new generation of predictions
+            prediction_map.invalidate()
+
+search_cache = SearchCache(max_rows=int(os.getenv('SEARCH_CACHE_MAX_ROWS', '50000')),
+                           marker_interval=float(os.getenv('SEARCH_CACHE_MARKER_INTERVAL', '60')))
+
+def get_scrape_marker():
+    """ returns time the scraper last completed a run, or None if unknown """
+    try:
+        with borrow_connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(f'SELECT MAX(Completed) AS Completed FROM {SCRAPE_LOG_TABLE_NAME}')
+            return cursor.fetchone().Completed
+    except (pyodbc.Error, sqlite3.Error) as e:
+        print(f'get_scrape_marker could not read {SCRAPE_LOG_TABLE_NAME}: {e}')
+        return None
+
+def mark_scrape_completed(cursor: pyodbc.Cursor):
+    """ logs a completed scraper run, so the web app clears its cached searches. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    """
+    if not is_valid_tname(cursor, SCRAPE_LOG_TABLE_NAME):
+        cursor.execute(f'CREATE TABLE {SCRAPE_LOG_TABLE_NAME} (Completed datetime)')
+    cursor.execute(f'INSERT INTO {SCRAPE_LOG_TABLE_NAME} (Completed) VALUES (?)', datetime.now())
+
+# ways to match recipes to the food name. 'exact' is the food name, 'prefix' is a word 
+# starting with the food name, and 'names' is a list of recipe names from recipe_index
+RECIPE_MATCHES = ['exact', 'prefix', 'names']
+def get_where_clause(filters: str, match: str):
+    """ returns (list of SQL where clause elements, list of their parameter slots) for the
+    recipe, mealtime, and location filters. Slots are filled in by bind_params
 
     :param filters: string determining selection filters. assume already validated.
-    :param food_name: name of food to search
-    :param exact_match: search for exact matches to food_name. (for details page)
-    :param table_names: used for date filters
+    :param match: how recipes are matched, one of RECIPE_MATCHES
     """
     
     # convert to list
     filters = list(filters)
 
-    # handle special char ' (SQL syntax does not allow ')
-    if "'" in food_name:
-        food_name = food_name.replace("'","''") 
-
-    # determine whether to search for exact matches to food_name
-    if exact_match:
-        recipe_select = f"Recipe='{food_name}'" 
+    # determine how to match recipes to food name
+    if match == 'exact':
+        recipe_select = 'Recipe=?'
+        slots = ['name']
+    elif match == 'names':
+        # recipe names are sent as a JSON array, so the query is the same for any number of them
+        if use_replica():
+            recipe_select = 'Recipe IN (SELECT value FROM json_each(?))'
+        else:
+            recipe_select = 'Recipe IN (SELECT CAST([value] AS varchar(65)) FROM OPENJSON(?))'
+        slots = ['names']
     else:
-        recipe_select = f"(Recipe LIKE '% {food_name}%' OR Recipe LIKE '{food_name}%')" 
-
-    # order clause - displays search results in order by these column values
-    order_clause = ' ORDER BY Recipe, [Date], Mealtime'
+        recipe_select = '(Recipe LIKE ? OR Recipe LIKE ?)'
+        slots = ['name_word', 'name_start']
 
     # Start building where clause (list of filters elements)
     where_clause = [recipe_select]
@@ -231,87 +640,195 @@ def get_filtered_query(filters: str, food_name: str, exact_match: bool,
             loc_filters = f'({" OR ".join(loc_filters)})'
             where_clause.append(loc_filters)
     # else, search all locations
-    
-    # Add time filters and return
+
+    return where_clause, slots
+
+def bind_params(slots: tuple, food_name: str, start_date: datetime, end_date: datetime, 
+                recipe_names: list = None):
+    """ returns tuple of query parameters, filling each slot from a query template
+
+    :param slots: parameter slots of the query, from QueryTemplates
+    :param food_name: name of food to search
+    :param start_date: first date searched, from get_time_range
+    :param end_date: last date searched, from get_time_range
+    :param recipe_names: recipes to search, for the 'names' match
+    """
+    values = {'name': food_name, 'name_word': f'% {food_name}%', 'name_start': f'{food_name}%',
+              'names': json.dumps(recipe_names), 'start': start_date, 'end': end_date}
+    return tuple(values[slot] for slot in slots)
+
+class QueryTemplates:
+    """ SQL query templates for every combination of filters
+
+    There are only a few filter settings (the time filter and 6 mealtime/location toggles),
+    so every query is built ahead of time. A search then only looks up its template and fills
+    in the parameters with bind_params. Templates depend on the date and on which tables
+    exist, so they are rebuilt by get_query_templates when either changes.
+    """
+
+    # None is the entire history, used by the details page
+    TIME_FILTERS = [f'{MFilters.TIME_SHORT.value}', f'{MFilters.TIME_FUTURE.value}', 
+                    f'{MFilters.TIME_PAST.value}', None]
+    NUM_TOGGLES = MFilters.NUM_FILTERS.value - 1
+
+    def __init__(self, today: datetime, existing_tables: frozenset):
+        """
+        :param today: date the templates are built for
+        :param existing_tables: names of monthly tables present in database
+        """
+        self.today = today
+        self.existing_tables = existing_tables
+        self._templates = {}
+
+        # build template for each time filter, toggles combination, and recipe match
+        for time_filter in self.TIME_FILTERS:
+            plan = plan_date_range(*get_time_range(time_filter, today), existing_tables)
+            for toggles_num in range(2 ** self.NUM_TOGGLES):
+                toggles = format(toggles_num, f'0{self.NUM_TOGGLES}b')
+                for match in RECIPE_MATCHES:
+                    where_clause, where_slots = get_where_clause('0' + toggles, match)
+                    self._templates[(time_filter, toggles, match)] = \
+                        build_range_query(plan, where_clause, where_slots)
+
+    def get(self, time_filter: str, filters: str, match: str):
+        """ returns (SQL query string or None, tuple of parameter slots) 
+
+        :param time_filter: digit of filters string at MFilters.TIME, or None for entire history
+        :param filters: string determining selection filters. assume already validated.
+        :param match: how recipes are matched, one of RECIPE_MATCHES
+        """
+        return self._templates[(time_filter, filters[1:], match)]
+
+_templates = None
+_templates_lock = threading.Lock()
+def get_query_templates(today: datetime, existing_tables: set) -> QueryTemplates:
+    """ returns the shared query templates, rebuilt if the date or tables have changed """
+    global _templates
+    existing_tables = frozenset(existing_tables)
+    with _templates_lock:
+        if _templates is None or _templates.today != today or _templates.existing_tables != existing_tables:
+            _templates = QueryTemplates(today, existing_tables)
+        return _templates
+
+def get_filtered_query(filters: str, food_name: str, exact_match: bool, recipe_names: list = None):
+    """ returns (SQL query string, tuple of parameters) for database using filters.
+    query is None if no tables are in range
+
+    :param filters: string determining selection filters. assume already validated.
+    :param food_name: name of food to search
+    :param exact_match: search for exact matches to food_name. (for details page)
+    :param recipe_names: if given, search exactly these recipes instead of matching food_name
+    """
+
+    # determine how to match recipes
+    if exact_match:
+        match = 'exact'
+    else:
+        match = 'prefix' if recipe_names is None else 'names'
+
+    # Look up the prebuilt query, then fill in its parameters
     today = get_today()
-    if filters[MFilters.TIME.value] == f'{MFilters.TIME_SHORT.value}':
+    templates = get_query_templates(today, menu_catalog.get())
+    query, slots = templates.get(filters[MFilters.TIME.value], filters, match)
+    start_date, end_date = get_time_range(filters[MFilters.TIME.value], today)
+    return query, bind_params(slots, food_name, start_date, end_date, recipe_names)
+
+def get_time_range(time_filter: str, today: datetime):
+    """ returns (start date, end date) searched by a time filter. None means unbounded
+
+    :param time_filter: digit of filters string at MFilters.TIME, or None for entire history
+    :param today: from get_today
+    """
+    if time_filter is None:
+        return None, None
+    elif time_filter == f'{MFilters.TIME_SHORT.value}':
         # TIME_SHORT case: searches to up to MFilters.TIME_SHORT_LIMIT - 1 days ahead
-        # For the main menu search
-        start_date = today
-        end_date = (today + timedelta(days=MFilters.TIME_SHORT_LIMIT.value - 1))
-        if start_date.month == end_date.month:
-            # both dates are in same month
-            start_date = start_date.strftime("%m/%d/%Y")
-            end_date = end_date.strftime("%m/%d/%Y")
-            where_clause.append(f"([Date] BETWEEN '{start_date}' AND '{end_date}')")
-            
-            # combine query elements to form full query and return
-            return f'SELECT * from {get_table_name(today)} WHERE ' + ' AND '.join(where_clause) + order_clause
-        else:
-            # end_date is in another month and thus table. Must join tables
-            start_date_str = start_date.strftime("%m/%d/%Y")
-            where_clause.append(f"([Date] >= '{start_date_str})'")
-            table1 = f'SELECT * from {get_table_name(start_date)} WHERE' + ' AND '.join(where_clause)
-            where_clause.pop() # remove previous date filter, preserving other filters
-            start_date = start_date.strftime("%m/%d/%Y")
-            end_date = end_date.strftime("%m/%d/%Y")
-            where_clause.append(f"([Date] BETWEEN '{start_date}' AND '{end_date}')")
-            table2 = f'SELECT * from {get_table_name(end_date)} WHERE' + ' AND '.join(where_clause)
-            
-            # combine query elements to form full query and return
-            return f'{table1} UNION {table2} {order_clause}'
-        
-    elif filters[MFilters.TIME.value] == f'{MFilters.TIME_FUTURE.value}':
+        return today, today + timedelta(days=MFilters.TIME_SHORT_LIMIT.value - 1)
+    elif time_filter == f'{MFilters.TIME_FUTURE.value}':
         # TIME_FUTURE case: searches today and beyond
-        start_date = today
-        today_str = today.strftime("%m/%d/%Y")
-        where_clause.append(f"([Date] >= '{today_str}')")
-        table1 = f'SELECT * from {get_table_name(today)} WHERE ' + ' AND '.join(where_clause)
-
-        # case: check if date range extends to next month and thus need to join tables
-        month = start_date.month + 1 if start_date.month != 12 else 1
-        year = start_date.year if month != 1 else start_date.year + 1
-        next_month = datetime(year, month, 1)
-        next_tname = get_table_name(next_month)
-        if is_valid_tname(cursor, next_tname):
-            # Add next month's table
-            where_clause.pop() # remove previous date filter, preserving other filters
-            table2 = f'SELECT * from {next_tname} WHERE ' + ' AND '.join(where_clause)
-
-            # combine query elements to form full query and return
-            return f'{table1} UNION {table2} {order_clause}'
-        else:
-            # date range ends within this month. combine query elements and return
-            return f'{table1} {order_clause}'
-    
+        return today, None
     else:
         # TIME PAST case: searches everything before today, exclusive
-        today = get_today()
-        start_date = datetime(2024, 7, 1) # database won't contain any data before july 2024
-        end_date = datetime(today.year, today.month, 1)
-        temp_date = start_date
-
-        # build list of tables to search
-        tables = []
-
-        # add past tables
-        while not(temp_date.year == end_date.year and temp_date.month == end_date.month):
-            tables.append(get_table_name(temp_date))
-            month = temp_date.month + 1 if temp_date.month != 12 else 1
-            year = temp_date.year if month != 1 else temp_date.year + 1
-            temp_date = datetime(year, month, 1)
-        
-        # combine query elements to form partial query
-        where_clause_partial = ' AND '.join(where_clause)
-        select_clauses = [f'SELECT * from {table} WHERE {where_clause_partial}' for table in tables]
-
-        # add this month's table and date filter
-        where_clause.append(f"([Date] >= '{today.strftime('%m/%d/%Y')}')")
-        where_clause_final = ' AND '.join(where_clause)
-        select_clauses.append(f'SELECT * from {get_table_name(temp_date)} WHERE {where_clause_final}')
-
-        # combine query elements to form full query and return
-        return ' UNION '.join(select_clauses) + order_clause
+        return None, today - timedelta(days=1)
+
+# database won't contain any data before july 2024
+FIRST_TABLE_DATE = datetime(2024, 7, 1)
+ORDER_CLAUSE = ' ORDER BY Recipe, [Date], Mealtime'
+def plan_date_range(start_date: datetime, end_date: datetime, existing_tables: set):
+    """ returns list of (table name, start date, end date) to search for a date range
+
+    Picks the monthly tables overlapping the range, skipping ones not in existing_tables.
+    Each table's dates are None when the table is entirely inside that side of the range,
+    so no date filter is needed there. If the DB_MENU_VIEW environment variable names a
+    consolidated table or view (same columns as the monthly tables, indexed on [Date]),
+    it is searched instead of the monthly tables.
+
+    :param start_date: first date to search, inclusive. None for no lower bound
+    :param end_date: last date to search, inclusive. None for no upper bound
+    :param existing_tables: names of monthly tables present in database
+    """
+    
+    # consolidated backend, a single range-filtered table
+    menu_view = os.getenv('DB_MENU_VIEW')
+    if menu_view:
+        return [(menu_view, start_date, end_date)]
+
+    # find first and last months to search
+    first_month = FIRST_TABLE_DATE if start_date is None else max(get_month_start(start_date), FIRST_TABLE_DATE)
+    if end_date is not None:
+        last_month = get_month_start(end_date)
+    else:
+        table_months = [get_table_month(table) for table in existing_tables]
+        last_month = max([month for month in table_months if month is not None], default=first_month)
+
+    # add each month's table, if it exists
+    plan = []
+    month = first_month
+    while month <= last_month:
+        next_month = get_next_month(month)
+        table_name = get_table_name(month)
+        if table_name in existing_tables:
+            table_start = start_date if start_date is not None and start_date > month else None
+            table_end = end_date if end_date is not None and end_date < next_month - timedelta(days=1) else None
+            plan.append((table_name, table_start, table_end))
+        month = next_month
+
+    return plan
+
+def build_range_query(plan: list, where_clause: list, where_slots: list):
+    """ returns (SQL query string, tuple of parameter slots) searching each table in plan.
+    query is None if plan is empty
+
+    Values are passed as ? parameters so the query text stays the same between searches
+    and the server can reuse its compiled plan. Fill in the slots with bind_params.
+
+    :param plan: from plan_date_range
+    :param where_clause: list of filters elements, applied to every table
+    :param where_slots: parameter slots of where_clause
+    """
+    select_clauses = []
+    slots = []
+    for table_name, table_start, table_end in plan:
+        # add this table's date filter, if it is only partially searched
+        table_where = list(where_clause)
+        slots.extend(where_slots)
+        if table_start is not None and table_end is not None:
+            table_where.append('([Date] BETWEEN ? AND ?)')
+            slots.extend(['start', 'end'])
+        elif table_start is not None:
+            table_where.append('([Date] >= ?)')
+            slots.append('start')
+        elif table_end is not None:
+            table_where.append('([Date] <= ?)')
+            slots.append('end')
+        select_clauses.append(f'SELECT * from {table_name} WHERE ' + ' AND '.join(table_where))
+
+    if select_clauses == []:
+        return None, ()
+
+    # each table holds different dates, and rows are stored once (see dedupe_menu_tables), so
+    # results never need to be deduplicated with UNION
+    return ' UNION ALL '.join(select_clauses) + ORDER_CLAUSE, tuple(slots)
 
 def get_table_name(date: datetime):
     """ returns table name in database for a date """
@@ -323,6 +840,362 @@ def is_valid_tname(cursor: pyodbc.Cursor, table_name: str):
     """ Returns true if table_name is a valid table name (present in cursor's database), false otherwise """
     return cursor.tables(table=table_name, tableType='TABLE').fetchone() is not None
 
+def get_table_month(table_name: str):
+    """ returns first day of month stored in a monthly table, or None if not a monthly table """
+    prefix = f"{os.getenv('DB_TABLE_PREFIX')}_"
+    if not table_name.startswith(prefix):
+        return None
+    year, _, month = table_name[len(prefix):].partition('_')
+    if not (year.isdigit() and month.isdigit() and 1 <= int(month) <= 12):
+        return None
+    return datetime(int(year), int(month), 1)
+
+def list_menu_tables(cursor: pyodbc.Cursor):
+    """ returns set of monthly table names present in cursor's database, in one catalog call """
+    if isinstance(cursor, sqlite3.Cursor):
+        tables = cursor.execute("SELECT name AS table_name FROM sqlite_master WHERE type='table'").fetchall()
+    else:
+        tables = cursor.tables(tableType='TABLE').fetchall()
+    return {table.table_name for table in tables if get_table_month(table.table_name) is not None}
+
+class BackgroundLoader:
+    """ base class for data kept in memory and loaded from the database without making 
+    requests wait
+
+    Subclasses implement _load(cursor). Data is stale after ttl seconds or once invalidated,
+    and refresh_if_stale() then reloads it in a background thread with a pooled connection.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: seconds the data is kept before it is loaded again
+        """
+        self.ttl = ttl
+        self._loaded = None  # time.monotonic() of last load, None if stale
+        self._invalidations = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def refresh(self, cursor: pyodbc.Cursor):
+        """ loads the data with cursor """
+        with self._lock:
+            invalidations = self._invalidations
+        self._load(cursor)
+        with self._lock:
+            # invalidated while loading, the data may already be out of date
+            if self._invalidations == invalidations:
+                self._loaded = time.monotonic()
+
+    def is_current(self):
+        """ returns whether the data has been loaded since it was last invalidated. Results
+        built from data that isn't current may be missing new tables or recipes """
+        with self._lock:
+            return self._loaded is not None
+
+    def refresh_if_stale(self):
+        """ starts loading the data in a background thread if it is stale """
+        with self._lock:
+            start_refresh = self._is_stale() and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if start_refresh:
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def invalidate(self):
+        """ marks the data as stale, so it is loaded again on next use """
+        with self._lock:
+            self._loaded = None
+            self._invalidations += 1
+
+    def _load(self, cursor: pyodbc.Cursor):
+        raise NotImplementedError
+
+    def _is_stale(self):
+        """ call with lock held """
+        return self._loaded is None or time.monotonic() - self._loaded > self.ttl
+
+    def _refresh_in_background(self):
+        try:
+            with borrow_connection() as connection:
+                self.refresh(connection.cursor())
+        except Exception as e:
+            print(f'{type(self).__name__} could not load from database: {e}')
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+class TableCatalog(BackgroundLoader):
+    """ thread-safe cache of the monthly table names present in database
+
+    The names are listed in one catalog call and kept for ttl seconds. The web app reads
+    them with get(), which never waits on the database: stale names are refreshed in a
+    background thread. The scraper reads them with load(cursor), and calls add() when it
+    creates a new monthly table.
+    """
+
+    def __init__(self, ttl: float):
+        super().__init__(ttl)
+        self._tables = None
+
+    def get(self) -> frozenset:
+        """ returns table names without querying the database, refreshing in the background if
+        stale. Until the first listing completes, assumes tables exist for each month from 
+        FIRST_TABLE_DATE through this month 
+        """
+        self.refresh_if_stale()
+        tables = self._tables
+        return tables if tables is not None else self.guess_tables()
+
+    def load(self, cursor: pyodbc.Cursor) -> frozenset:
+        """ returns table names, listing them with cursor if stale """
+        with self._lock:
+            is_stale = self._is_stale()
+        if is_stale:
+            self.refresh(cursor)
+        return self._tables
+
+    def add(self, table_name: str):
+        """ records a newly created table """
+        with self._lock:
+            if self._tables is not None:
+                self._tables = self._tables | {table_name}
+
+    @staticmethod
+    def guess_tables() -> frozenset:
+        """ returns names of tables expected to exist, from FIRST_TABLE_DATE through this month """
+        tables = []
+        month = FIRST_TABLE_DATE
+        while month <= get_today():
+            tables.append(get_table_name(month))
+            month = get_next_month(month)
+        return frozenset(tables)
+
+    def _load(self, cursor: pyodbc.Cursor):
+        tables = frozenset(list_menu_tables(cursor))
+        with self._lock:
+            self._tables = tables
+
+menu_catalog = TableCatalog(ttl=float(os.getenv('TABLE_CATALOG_TTL', '300')))
+
+class RecipeIndex(BackgroundLoader):
+    """ in-memory index of distinct recipe names, for matching searches without the database
+
+    Matches the same recipes as the 'prefix' query: names where a word starts with the search
+    term, ignoring case. Every suffix of a name that starts at a word is kept in a sorted 
+    list, so a search is a binary search for suffixes starting with the term. Only the newest
+    tables get new recipes, so after the first load only tables from this month onwards are
+    read again when the index is refreshed. The number of days each recipe was served and the
+    last date it was served are kept to rank suggestions.
+    """
+
+    # characters with special meaning in LIKE patterns, searches with them use the database
+    LIKE_WILDCARDS = '%_['
+
+    def __init__(self, ttl: float):
+        super().__init__(ttl)
+        self._suffixes = []  # sorted list of (lowercase suffix of a name, name)
+        self._names = set()
+        self._table_stats = {}  # table name: {name: (days served, last date served)}
+        self._scores = {}  # name: suggestion rank, higher first
+        self._loaded_tables = set()
+        self._ready = False
+
+    def match(self, food_name: str):
+        """ returns sorted list of recipe names matching food_name, or None if the index can't
+        be used (not loaded yet, reloading after a new scrape, or food_name contains LIKE wildcards) """
+        self.refresh_if_stale()
+        if not self._ready or not self.is_current() or any(char in food_name for char in self.LIKE_WILDCARDS):
+            return None
+        return sorted(self._find(food_name))
+
+    def suggest(self, food_name: str, limit: int):
+        """ returns up to limit recipe names matching food_name, most often and most recently
+        served first. Empty if the index is not loaded yet """
+        self.refresh_if_stale()
+        if not self._ready:
+            return []
+        scores = self._scores
+        return heapq.nlargest(limit, self._find(food_name), key=lambda name: (scores.get(name, 0), name))
+
+    @staticmethod
+    def get_scores(stats: dict, today: datetime):
+        """ returns dictionary of name: suggestion rank. Frequently served recipes rank higher,
+        fading over the months since they were last served
+
+        :param stats: dictionary of name: (days served, last date served)
+        :param today: from get_today
+        """
+        scores = {}
+        for name, (days_served, last_served) in stats.items():
+            days_since = max((today - last_served).days, 0)
+            scores[name] = days_served / (1 + days_since / 30)
+        return scores
+
+    def _find(self, food_name: str):
+        """ returns set of recipe names with a word starting with food_name """
+        # suffixes starting with the term are next to each other in the sorted list
+        term = food_name.lower()
+        suffixes = self._suffixes
+        matches = set()
+        i = bisect.bisect_left(suffixes, (term,))
+        while i < len(suffixes) and suffixes[i][0].startswith(term):
+            matches.add(suffixes[i][1])
+            i += 1
+        return matches
+
+    def add(self, names):
+        """ adds recipe names to the index """
+        with self._lock:
+            new_names = set(names) - self._names
+            new_suffixes = sorted((suffix, name) for name in new_names for suffix in self.word_suffixes(name))
+            self._suffixes = list(heapq.merge(self._suffixes, new_suffixes))
+            self._names |= new_names
+
+    @staticmethod
+    def word_suffixes(name: str):
+        """ returns lowercase suffixes of name that start at the beginning or after a space """
+        name = name.lower()
+        return [name] + [name[i + 1:] for i, char in enumerate(name) if char == ' ']
+
+    def _load(self, cursor: pyodbc.Cursor):
+        # read tables not loaded yet, and tables that may still get new recipes
+        this_month = get_month_start(get_today())
+        tables = [table for table in menu_catalog.load(cursor) 
+                  if table not in self._loaded_tables or get_table_month(table) >= this_month]
+        if tables:
+            query = ' UNION ALL '.join(f"SELECT '{table}' AS TableName, Recipe, COUNT(DISTINCT [Date]) AS Days, "\
+                                       f"MAX([Date]) AS LastDate FROM {table} GROUP BY Recipe" for table in tables)
+            cursor.execute(query)
+            rows = cursor.fetchall()
+
+            # replace stats of the tables read, then total them across tables
+            for table in tables:
+                self._table_stats[table] = {}
+            for row in rows:
+                self._table_stats[row.TableName][row.Recipe] = (row.Days, row.LastDate)
+            stats = {}
+            for table_stats in self._table_stats.values():
+                for name, (days_served, last_served) in table_stats.items():
+                    total_days, total_last = stats.get(name, (0, last_served))
+                    stats[name] = (total_days + days_served, max(total_last, last_served))
+            self._scores = self.get_scores(stats, get_today())
+
+            self.add(row.Recipe for row in rows)
+            self._loaded_tables.update(tables)
+        self._ready = True
+
+recipe_index = RecipeIndex(ttl=float(os.getenv('RECIPE_INDEX_TTL', '3600')))
+
+MAX_SUGGESTIONS = 20
+def suggest_recipes(food_name: str, limit: int = 8):
+    """ returns names of recipes matching food_name for autocomplete, without querying the
+    database. Most often and most recently served recipes come first
+
+    :param food_name: start of a word in the recipe names, as typed so far
+    :param limit: number of names to return, at most MAX_SUGGESTIONS
+    """
+    if not food_name:
+        return []
+    return recipe_index.suggest(food_name, max(0, min(limit, MAX_SUGGESTIONS)))
+
+def ensure_recipe_index(cursor: pyodbc.Cursor, table_name: str):
+    """ creates an index on Recipe for a monthly table if it does not have one. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    :param table_name: name of monthly table
+    """
+    index_name = f'IX_{table_name}_Recipe'
+    cursor.execute("IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = ?) "\
+                   f"CREATE INDEX {index_name} ON {table_name} (Recipe, [Date])", index_name)
+
+def list_existing_menu_tables(cursor: pyodbc.Cursor):
+    """ returns set of monthly table names for a migration to change, raising RuntimeError if
+    there are none, so a migration that found no tables isn't recorded as applied """
+    tables = list_menu_tables(cursor)
+    if not tables:
+        raise RuntimeError(f"No monthly tables named {os.getenv('DB_TABLE_PREFIX')}_(year)_(month) found to migrate")
+    return tables
+
+def remove_duplicate_rows(cursor: pyodbc.Cursor, table_name: str):
+    """ deletes repeats of the same recipe, date, mealtime, and location from a monthly table,
+    keeping one of each. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    :param table_name: name of monthly table
+    """
+    cursor.execute(f'WITH numbered AS (SELECT ROW_NUMBER() OVER (PARTITION BY Recipe, [Date], Mealtime, [Location] '\
+                   f'ORDER BY (SELECT NULL)) AS RowNum FROM {table_name}) DELETE FROM numbered WHERE RowNum > 1')
+
+def dedupe_menu_tables(cursor: pyodbc.Cursor):
+    """ removes duplicate rows written by earlier versions of the scraper from every monthly
+    table, so searches can combine tables with UNION ALL. DOES NOT COMMIT """
+    for table_name in sorted(list_existing_menu_tables(cursor)):
+        remove_duplicate_rows(cursor, table_name)
+
+def index_menu_tables(cursor: pyodbc.Cursor):
+    """ creates the recipe index of every monthly table created before tables were indexed when
+    created. DOES NOT COMMIT """
+    for table_name in sorted(list_existing_menu_tables(cursor)):
+        ensure_recipe_index(cursor, table_name)
+
+MIGRATION_TABLE_NAME = 'schema_migrations'
+def run_migrations(cursor: pyodbc.Cursor):
+    """ applies each of MIGRATIONS not yet recorded in MIGRATION_TABLE_NAME, and returns names of
+    those applied. Once all are applied this is one lookup. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    """
+    cursor.execute(f"IF OBJECT_ID('{MIGRATION_TABLE_NAME}', 'U') IS NULL "\
+                   f"CREATE TABLE {MIGRATION_TABLE_NAME} (Name varchar(100) PRIMARY KEY, Applied datetime)")
+    cursor.execute(f'SELECT Name FROM {MIGRATION_TABLE_NAME}')
+    applied = {row.Name for row in cursor.fetchall()}
+
+    new_migrations = []
+    for name, migrate in MIGRATIONS:
+        if name not in applied:
+            migrate(cursor)
+            cursor.execute(f'INSERT INTO {MIGRATION_TABLE_NAME} (Name, Applied) VALUES (?, ?)', (name, datetime.now()))
+            new_migrations.append(name)
+    return new_migrations
+
+# one-time changes to existing tables, in the order they are applied
+MIGRATIONS = [('dedupe_menu_rows', dedupe_menu_tables), ('recipe_index', index_menu_tables)]
+
+INSERT_BATCH_SIZE = int(os.getenv('DB_INSERT_BATCH_SIZE', '1000'))
+def insert_rows(cursor: pyodbc.Cursor, table_name: str, columns: list, rows: list, batch_size: int = None):
+    """ inserts rows into a table in batches, with one round trip per batch. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    :param table_name: name of table
+    :param columns: column names, in the order of each row
+    :param rows: list of tuples to insert
+    :param batch_size: rows sent per round trip, defaults to DB_INSERT_BATCH_SIZE
+    """
+    batch_size = batch_size or INSERT_BATCH_SIZE
+    placeholders = ', '.join('?' for _ in columns)
+    instr = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+
+    # pyodbc sends each batch as one parameter array instead of a statement per row
+    fast_executemany = getattr(cursor, 'fast_executemany', None)
+    if fast_executemany is not None:
+        cursor.fast_executemany = True
+    try:
+        for start in range(0, len(rows), batch_size):
+            cursor.executemany(instr, rows[start:start + batch_size])
+    finally:
+        if fast_executemany is not None:
+            cursor.fast_executemany = fast_executemany
+
+def get_month_start(date: datetime):
+    """ returns the first day of date's month """
+    return datetime(date.year, date.month, 1)
+
+def get_next_month(date: datetime):
+    """ returns the first day of the month after date's month """
+    month = date.month + 1 if date.month != 12 else 1
+    year = date.year if month != 1 else date.year + 1
+    return datetime(year, month, 1)
+
 def get_today() -> datetime:
     """ Returns the today's date, Austin time """
     # Get the current time in UTC
@@ -337,109 +1210,147 @@ def get_today() -> datetime:
     # Print the new datetime object
     return cst_today
 
-def download_database_csv(cursor: pyodbc.Cursor):
-    # get dates to search from all tables
-    today = get_today()
-    start_date = datetime(2024, 7, 1) # database won't contain any data before july 2024
-    end_date = datetime(today.year, today.month, 1)
-    temp_date = start_date
-
-    # build list of tables to search
-    tables = []
-
-    # add past tables
-    while not(temp_date.year == end_date.year and temp_date.month == end_date.month):
-        tables.append(get_table_name(temp_date))
-        month = temp_date.month + 1 if temp_date.month != 12 else 1
-        year = temp_date.year if month != 1 else temp_date.year + 1
-        temp_date = datetime(year, month, 1)
-
-    # add this month's table
-    tables.append(get_table_name(temp_date))
-
-    # add next month's table if available
-    month = end_date.month + 1 if end_date.month != 12 else 1
-    year = end_date.year if month != 1 else end_date.year + 1
-    next_month = datetime(year, month, 1)
-    next_tname = get_table_name(next_month)
-    if is_valid_tname(cursor, next_tname):
-        tables.append(next_tname)
-
-    # combine query elements to full query
-    order_clause = ' ORDER BY Recipe, [Date], Mealtime'
-    select_clauses = [f'SELECT * from {table}' for table in tables]
-    query = ' UNION '.join(select_clauses) + order_clause
-
-    # Execute query
-    print (f"Download_database_csv: Executing query {query}.")
-    # smaller query for safety - delete this line later
-    query = "select * from [dbo].[menu_2025_2] UNION select * from [dbo].[menu_2025_1]"
-    cursor.execute(query)
-
-    # Fetch results of query
-    rows = cursor.fetchall()
-
-    # Extract data and store into a list in the details page format
-    entire_db = []
-    for row in rows:
-        # add One Hot Encoding for Mealtimes and Locations. format:
-        # food name, date, isBreakfast?, isLunch?, isDinner?, isKins?, isJ2?, isJCL?
-        entire_db.append([row.Recipe, row.Date, int(row.Mealtime == 1), 
-                          int(row.Mealtime == 2), int(row.Mealtime == 3), 
-                          int(row.Location == 1), int(row.Location == 2), 
-                          int(row.Location == 3)])
-
-    # Converting entire db to a dataframe & then to .CSV
-    entire_db_df = pd.DataFrame(entire_db)
-    entire_db_df.to_csv(ENTIRE_DATABASE_CSV_FILENAME, index=False)
-
-    print (f"download_entire_database_csv completed: Saved entire database into {ENTIRE_DATABASE_CSV_FILENAME}")
-
 PREDICTION_TABLE_NAME = 'predict_test'
-def save_predictions_to_db(prediction_array, cursor, location_code):
+# locations predicted, each published in every generation
+PREDICTION_LOCATIONS = [location for location in LocationCodesNum if location != LocationCodesNum.ERR]
+GENERATION_TABLE_NAME = 'prediction_generations'
+# number of published generations of predictions kept, including the current one
+PREDICTION_RETENTION = int(os.getenv('PREDICTION_RETENTION', '3'))
+def publish_predictions(predictions: dict, cursor: pyodbc.Cursor):
+    """ publishes predictions of every location as a new generation, replacing the current one
+    when committed, and prunes generations older than PREDICTION_RETENTION. Raises ValueError
+    instead if any of PREDICTION_LOCATIONS has no predictions, keeping the current generation.
+    DOES NOT COMMIT
+
+    Rows are bulk inserted into PREDICTION_TABLE_NAME under the new generation. Readers only see
+    the generation once its row in GENERATION_TABLE_NAME is committed, so they never see a partly
+    written set.
+
+    :param predictions: dictionary of location code: 2d array formatted like food, date1, date2, date3
+    :param cursor: cursor to the database, executes writes
     """
-    prediction array: 2d array formated like food, date1, date2, date3
-    location: must be in LOCATION_CODES
-    cursor: connection to database
+    # checked here rather than on import, since the web app doesn't publish
+    if PREDICTION_RETENTION < 1:
+        raise ValueError(f'PREDICTION_RETENTION must keep at least the current generation, got {PREDICTION_RETENTION}')
+    # an empty or partial generation would replace, and then prune, complete ones
+    missing = [location.name for location in PREDICTION_LOCATIONS if len(predictions.get(location.value, ())) == 0]
+    if missing:
+        raise ValueError(f'No predictions for {", ".join(missing)}, keeping the current generation')
+
+    ensure_prediction_tables(cursor)
+    cursor.execute(f'SELECT COALESCE(MAX(Generation), 0) + 1 AS Generation FROM {GENERATION_TABLE_NAME}')
+    generation = cursor.fetchone().Generation
+
+    # Collect each prediction
+    rows = []
+    for location_code, prediction_array in predictions.items():
+        for prediction in prediction_array:
+            # add each date
+            food_name = prediction[0]
+            assert isinstance(food_name, str), f"Expected str, got {type(food_name)} instead."
+            for i in range(1, NUM_PREDICTIONS + 1):
+                date = prediction[i]
+                date = datetime (date.year, date.month, date.day)
+                rows.append((food_name, date, int(location_code), generation))
+
+    # Bulk insert under the new generation, which readers ignore until it is recorded below
+    insert_rows(cursor, PREDICTION_TABLE_NAME, ['Recipe', '[Date]', '[Location]', 'Generation'], rows)
+
+    # Make it the current generation
+    cursor.execute(f'INSERT INTO {GENERATION_TABLE_NAME} (Generation, Published, NumRows) VALUES (?, ?, ?)',
+                   (generation, datetime.now(), len(rows)))
+
+    # Prune old generations, and rows from before generations were recorded
+    oldest_kept = generation - PREDICTION_RETENTION + 1
+    cursor.execute(f'DELETE FROM {PREDICTION_TABLE_NAME} WHERE Generation < ? OR Generation IS NULL', (oldest_kept,))
+    cursor.execute(f'DELETE FROM {GENERATION_TABLE_NAME} WHERE Generation < ?', (oldest_kept,))
+
+    print (f"done publishing {len(rows)} predictions to {PREDICTION_TABLE_NAME} as generation {generation}")
+    return generation
+
+def ensure_prediction_tables(cursor: pyodbc.Cursor):
+    """ creates the predictions and generations tables and the predictions index if
+    missing, adding Generation to a predictions table from before generations. DOES NOT COMMIT
+
+    :param cursor: cursor to the database, executes writes
+    """
+    cursor.execute(f"IF OBJECT_ID('{PREDICTION_TABLE_NAME}', 'U') IS NULL "\
+                   f"CREATE TABLE {PREDICTION_TABLE_NAME} (Recipe varchar(65), [Date] datetime, [Location] int, Generation int)")
+    cursor.execute(f"IF COL_LENGTH('{PREDICTION_TABLE_NAME}', 'Generation') IS NULL "\
+                   f"ALTER TABLE {PREDICTION_TABLE_NAME} ADD Generation int")
+    cursor.execute(f"IF OBJECT_ID('{GENERATION_TABLE_NAME}', 'U') IS NULL "\
+                   f"CREATE TABLE {GENERATION_TABLE_NAME} (Generation int PRIMARY KEY, Published datetime, NumRows int)")
+    index_name = f'IX_{PREDICTION_TABLE_NAME}_Recipe'
+    cursor.execute("IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = ?) "\
+                   f"CREATE INDEX {index_name} ON {PREDICTION_TABLE_NAME} (Recipe, [Date]) INCLUDE ([Location], Generation)",
+                   (index_name,))
+
+class PredictionMap(BackgroundLoader):
+    """ in-memory map of each recipe's predictions in the current generation, so the details
+    page reads predictions without the database
+
+    Loaded on first use, then refreshed in a background thread when invalidated (after a
+    scrape completes, see SearchCache) or after ttl seconds. A refresh first checks the current
+    generation in GENERATION_TABLE_NAME, and only reads the predictions when a new generation
+    has been published. If loading fails, such as before the first generation is published, the
+    map stays as it was (empty at first) until the next refresh. Recipes are matched ignoring
+    case, like the database.
     """
-    # Write each prediction to the database
-    for prediction in prediction_array:
-        # write each date
-        food_name = prediction[0]
-        assert isinstance(food_name, str), f"Expected datetime object, got {type(food_name)} instead."
-        for i in range(1, NUM_PREDICTIONS + 1):
-            date = prediction[i]
-            date = datetime (date.year, date.month, date.day)
-            assert isinstance(date, datetime), f"Expected datetime object, got {type(date)} instead."
-            instr = f"INSERT INTO {PREDICTION_TABLE_NAME} (Recipe, [Date], [Location]) VALUES (?, ?, ?)"
-            cursor.execute(instr, food_name, date, location_code) 
-
-    print (f"done adding predictions to {PREDICTION_TABLE_NAME}")
-
-def get_predictions_from_db(food_name):
-    """ read from predictions """
-    
-    # Connect to database
-    connection = get_connection()
-    cursor = connection.cursor()
-
-    query = f"SELECT * FROM {PREDICTION_TABLE_NAME} WHERE Recipe='{food_name}' ORDER BY [Date]"
-
-    # Execute query
-    print(f'get_predictions_from_db searching for {food_name} with query {query}')
-    cursor.execute(query)
-
-    # Fetch results of query
-    rows = cursor.fetchall()
-
-    # Extract data and store into a list in the details page format
-    predictions = []
-    for row in rows:
-        date = row.Date.strftime("%d %B '%y").lstrip('0')
-        predictions.append([date, LOCATION_CODES[row.Location]])
 
-    # Close the connection
-    connection.close()
-    
-    print ("done fetching predictions")
-    return predictions
\ No newline at end of file
+    def __init__(self, ttl: float):
+        super().__init__(ttl)
+        self._predictions = None  # lowercase recipe: tuple of (date, location code), ordered by date
+        self._generation = None
+        self._first_load_lock = threading.Lock()
+
+    def get(self, food_name: str):
+        """ returns predictions of food_name in the details page format, loading them on first
+        use and refreshing in the background if stale """
+        if self._predictions is None:
+            self._load_first()
+        else:
+            self.refresh_if_stale()
+        predictions = self._predictions or {}
+        return [[date.strftime("%d %B '%y").lstrip('0'), LOCATION_CODES[location]]
+                for date, location in predictions.get(food_name.lower(), ())]
+
+    def _load_first(self):
+        """ loads the predictions once, for the first requests to use them """
+        with self._first_load_lock:
+            if self._predictions is not None:
+                return
+            try:
+                with borrow_connection() as connection:
+                    self.refresh(connection.cursor())
+            except (pyodbc.Error, sqlite3.Error) as e:
+                # retry when stale instead of on every request
+                print(f'PredictionMap could not connect to database: {e}')
+                with self._lock:
+                    self._loaded = time.monotonic()
+            if self._predictions is None:
+                self._predictions = {}
+
+    def _load(self, cursor: pyodbc.Cursor):
+        try:
+            cursor.execute(f'SELECT MAX(Generation) AS Generation FROM {GENERATION_TABLE_NAME}')
+            generation = cursor.fetchone().Generation
+            if generation == self._generation and self._predictions is not None:
+                return
+
+            cursor.execute(f'SELECT Recipe, [Date], [Location] FROM {PREDICTION_TABLE_NAME} '\
+                           'WHERE Generation=? ORDER BY [Date]', (generation,))
+            rows = cursor.fetchall()
+        except (pyodbc.Error, sqlite3.Error) as e:
+            print(f'PredictionMap could not load predictions: {e}')
+            return
+
+        predictions = {}
+        for row in rows:
+            predictions.setdefault(row.Recipe.lower(), []).append((row.Date, row.Location))
+        predictions = {recipe: tuple(entries) for recipe, entries in predictions.items()}
+        with self._lock:
+            self._predictions = predictions
+            self._generation = generation
+        print(f'PredictionMap loaded {len(predictions)} recipes from generation {generation}')
+
+prediction_map = PredictionMap(ttl=float(os.getenv('PREDICTION_MAP_TTL', '3600')))
@@ -0,0 +1,66 @@
+# page_archive.py
+# keeps every fetched menu page in a compressed, content-addressed archive on disk, so pages can be
+# parsed again offline. Identical pages are stored once, in ARCHIVE_DIR/objects/<hash[:2]>/<hash>.html.gz,
+# and ARCHIVE_DIR/index.jsonl records which page was fetched for each location, date, and fetch time
+
+import gzip
+import hashlib
+import json
+import os
+from datetime import datetime
+
+ARCHIVE_DIR = os.getenv('SCRAPER_ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'archive'))
+INDEX_FILENAME = 'index.jsonl'
+
+def archive_page(page: str, location_num: int, date: datetime, fetched: datetime, archive_dir: str = None):
+    """ stores a fetched page and records it in the index, returning the page's hash
+
+    :page: HTML text of the menu page
+    :location_num: of location the page is for
+    :date: the page is for
+    :fetched: time the page was fetched
+    :archive_dir: defaults to ARCHIVE_DIR
+    """
+    archive_dir = archive_dir or ARCHIVE_DIR
+    data = page.encode('utf-8')
+    page_hash = hashlib.sha256(data).hexdigest()
+
+    # write the page if this content isn't stored yet, renaming so readers never see a partial file
+    path = get_object_path(page_hash, archive_dir)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path + '.tmp', 'wb', compresslevel=9) as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+
+    # record the fetch
+    entry = {'location': location_num, 'date': date.strftime('%Y-%m-%d'),
+             'fetched': fetched.isoformat(timespec='seconds'), 'hash': page_hash}
+    with open(os.path.join(archive_dir, INDEX_FILENAME), 'a', encoding='utf-8') as file:
+        file.write(json.dumps(entry) + '\n')
+    return page_hash
+
+def get_object_path(page_hash: str, archive_dir: str = None):
+    """ returns path of the compressed page with page_hash """
+    return os.path.join(archive_dir or ARCHIVE_DIR, 'objects', page_hash[:2], f'{page_hash}.html.gz')
+
+def read_page(page_hash: str, archive_dir: str = None):
+    """ returns HTML text of the archived page with page_hash """
+    with gzip.open(get_object_path(page_hash, archive_dir), 'rb') as file:
+        return file.read().decode('utf-8')
+
+def load_latest_hashes(archive_dir: str = None):
+    """ returns dictionary of (date, location_num): hash of the most recently fetched page for each
+    location and date in the archive """
+    index_path = os.path.join(archive_dir or ARCHIVE_DIR, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {}
+
+    latest = {}  # (date, location_num): (fetched, hash)
+    with open(index_path, encoding='utf-8') as file:
+        for line in file:
+            entry = json.loads(line)
+            key = (datetime.strptime(entry['date'], '%Y-%m-%d'), entry['location'])
+            if key not in latest or entry['fetched'] >= latest[key][0]:
+                latest[key] = (entry['fetched'], entry['hash'])
+    return {key: page_hash for key, (_, page_hash) in latest.items()}
@@ -1,35 +1,57 @@
 # run_scraper.py
 # runs webscraper to add data to database
-# currently scrapes from all 3 dining halls up to CHECK_DAYS_AHEAD days in the future
-# requires requests and BeautifulSoup4 (web scraping) and pyodbc (database connection) to be installed
+# currently scrapes from all 3 dining halls up to CHECK_DAYS_AHEAD days in the future, and updates
+# pages up to REFRESH_DAYS_AHEAD days in the future whose recipes changed
+# fetched pages are saved to page_archive. To rebuild from the archive without the website, e.g.:
+#   python run_scraper.py --replay --start 2025-01-01 --days 30
+# The run is split into STAGES, each saving a checkpoint in CHECKPOINT_DIR. Running again resumes
+# from the first stage without a checkpoint, and one stage can be run again on its own with e.g.:
+#   python run_scraper.py --stage train
+# models are updated with the days settled since the last run, add --retrain to retrain them fully
+# timing and throughput of each run are added to telemetry.RUN_HISTORY_PATH
+# requires requests (web scraping) and pyodbc (database connection) to be installed
 
+import argparse
+import json
 import os
+import shutil
 import sys
+import time
 from datetime import datetime, timedelta
-import pyodbc 
-from scraper import scraper_main, get_logger
+import pyodbc
 from db_connection_info import CONNECTION_INFO # file ON MY COMPUTER storing login credentials
-from predict_future_date import make_predictions
-from searchdb import download_database_csv, ENTIRE_DATABASE_CSV_FILENAME
+# searchdb finds monthly tables by DB_TABLE_PREFIX, which is only set on the web app
+os.environ.setdefault('DB_TABLE_PREFIX', CONNECTION_INFO.DB_TABLE_PREFIX)
+from page_archive import archive_page, load_latest_hashes, read_page
+from scraper import fetch_pages, get_logger, get_page_hashes, get_scraped_pages, parse_menu, should_scrape, \
+    store_menu
+from searchdb import ensure_recipe_index, mark_scrape_completed, menu_catalog, publish_predictions, run_migrations
+from telemetry import append_run_history, metrics
 
 # import methods from searchdb: Add the parent directory to the system path to access it
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from searchdb import LOCATION_CODES
+from replica import sync_replica
+from training_data import export_training_data, TRAINING_DATASET_DIR
+from incremental_training import compute_predictions_incremental
 
 # the date to start scraping from
 START_DATE = datetime.today()
 # the number of days ahead from to scrape from
 CHECK_DAYS_AHEAD = 11
+# the number of days ahead to fetch again even if already scraped, to pick up menu changes
+REFRESH_DAYS_AHEAD = int(os.getenv('SCRAPER_REFRESH_DAYS_AHEAD', str(CHECK_DAYS_AHEAD)))
+
+# stages of a run, in order. Each reads the checkpoint of the stage before it
+STAGES = ['fetch', 'parse', 'write', 'export', 'train', 'publish']
+CHECKPOINT_DIR = os.getenv('SCRAPER_CHECKPOINT_DIR', os.path.join(os.path.dirname(__file__), 'checkpoints'))
+RUN_FILENAME = 'run.json'
 
 # define helper methods
 def get_table_name(date: datetime):
     """ returns table name in database for a date """
     return f'{CONNECTION_INFO.DB_TABLE_PREFIX}_{date.year}_{date.month}'
 
-def is_valid_tname(cursor: pyodbc.Cursor, table_name: str):
-    """ Returns true if table_name is a valid table name (present in cursor's database), false otherwise """
-    return cursor.tables(table=table_name, tableType='TABLE').fetchone() is not None
-
 LOCATION_CODES_URL = ['ERROR', '03', '12', '12(a)']
 LOCATION_STRINGS_URL = ['ERROR', 'Kins+Dining', 'J2+Dining', 'Jester+City+Limits+(JCL)']
 def get_url(location_num: int, date: datetime):
@@ -41,68 +63,273 @@ def get_url(location_num: int, date: datetime):
         f'&dtdate={date.month}%2f{date.day}%2f{date.year}'
     )
 
-# Log range
-logger = get_logger()
-logger.debug(f'Search starting from {START_DATE.date()} to {(START_DATE + timedelta(days=CHECK_DAYS_AHEAD)).date()}')
-
-# Connect to database
-connection_string = f"Driver={{ODBC Driver 18 for SQL Server}};Server=tcp:{CONNECTION_INFO.DB_SERVER_NAME},1433;Database={CONNECTION_INFO.DB_NAME};"\
-f"Uid={CONNECTION_INFO.DB_USERNAME};Pwd={CONNECTION_INFO.DB_PASSWORD};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
-connection = pyodbc.connect(connection_string)
-cursor = connection.cursor()
-
-# get first table
-date = datetime(START_DATE.year, START_DATE.month, START_DATE.day)
-table_name = get_table_name(date)
-
-# store tables written to in a list
-tables = []
-
-# scrape by location and date
-for i in range(0, CHECK_DAYS_AHEAD + 1):
-    # Create the table if it doesn't exist
-    if not is_valid_tname(cursor, table_name):
-        cursor.execute(f'''
-            CREATE TABLE {table_name} (
-                Recipe varchar(65),
-                Date datetime,
-                Mealtime int,
-                Location int
-            )
-        ''')
-        logger.debug(f'CREATED NEW TABLE {table_name} as it was not found')
-
-    # add table to list of tables
-    if tables == [] or tables[-1] != table_name:
-        tables.append(table_name)
-
-    # scrape from each dining hall location on this date
-    for loc_num in range(1, 4):
-        logger.debug(f'Scraping from {LOCATION_CODES[loc_num]}, {date.date()}')
-        url = get_url(loc_num, date)
-        scraper_main(url, loc_num, date, table_name, cursor)
-
-    # get next date and table_name
-    date += timedelta(days=1)
-    table_name = get_table_name(date)
-
-# commit writes
-connection.commit()
-logger.debug(f"Done writing data")
-
-# Convert Database into CSV for training models
-download_database_csv(cursor)
-
-# Re-train models with new data and save results into database
-make_predictions(cursor, ENTIRE_DATABASE_CSV_FILENAME)
-
-# commit writes
-connection.commit()
-logger.debug(f"Done predicting data and saving to database")
-
-# close the connection
-connection.close()
-
-# log success
-logger.info(f'Successfully scraped from {START_DATE.date()} to '\
-            f'{(date - timedelta(days=1)).date()} and stored into tables {", ".join(tables)}')
+def connect():
+    """ returns connection to the database """
+    connection_string = f"Driver={{ODBC Driver 18 for SQL Server}};Server=tcp:{CONNECTION_INFO.DB_SERVER_NAME},1433;Database={CONNECTION_INFO.DB_NAME};"\
+    f"Uid={CONNECTION_INFO.DB_USERNAME};Pwd={CONNECTION_INFO.DB_PASSWORD};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
+    return pyodbc.connect(connection_string)
+
+def get_window(settings: dict):
+    """ returns list of (date, table_name) for each day to scrape """
+    start = datetime.strptime(settings['start'], '%Y-%m-%d')
+    return [(start + timedelta(days=i), get_table_name(start + timedelta(days=i))) for i in range(settings['days'] + 1)]
+
+def sync_configured_replica(cursor: pyodbc.Cursor):
+    """ refreshes the web app's local replica with committed writes, if one is configured """
+    if os.getenv('DB_REPLICA_PATH'):
+        sync_replica(cursor, os.getenv('DB_REPLICA_PATH'))
+        get_logger().debug(f"Done syncing replica {os.getenv('DB_REPLICA_PATH')}")
+
+# define stages. Each takes the output of the stage before it, and returns (output, counts)
+def fetch_stage(settings: dict, _):
+    """ creates tables for the window, then fetches and archives pages that need scraping.
+    Outputs list of pages, with the archive hash of each page or None if it couldn't be fetched """
+    logger = get_logger()
+    connection = connect()
+    cursor = connection.cursor()
+
+    # an empty listing means the tables weren't recognized, and treating them as missing would
+    # create tables that already exist
+    if not menu_catalog.load(cursor):
+        raise RuntimeError(f'No monthly tables named {os.environ["DB_TABLE_PREFIX"]}_(year)_(month) found in database, '\
+                           'check DB_TABLE_PREFIX')
+
+    # apply one-time changes to existing tables
+    for migration in run_migrations(cursor):
+        logger.info(f'Applied migration {migration}')
+    connection.commit()
+
+    # Create the tables if they don't exist, indexing their recipes for searching
+    window = get_window(settings)
+    tables = list(dict.fromkeys(table_name for _, table_name in window))
+    for table_name in tables:
+        if table_name not in menu_catalog.load(cursor):
+            cursor.execute(f'''
+                CREATE TABLE {table_name} (
+                    Recipe varchar(65),
+                    Date datetime,
+                    Mealtime int,
+                    Location int
+                )
+            ''')
+            ensure_recipe_index(cursor, table_name)
+            menu_catalog.add(table_name)
+            logger.debug(f'CREATED NEW TABLE {table_name} as it was not found')
+    connection.commit()
+
+    # find pages already scraped in one query, and skip those past the refresh window without fetching
+    start_date, end_date = window[0][0], window[-1][0]
+    refresh_end = start_date + timedelta(days=settings['refresh_days'])
+    scraped_pages = get_scraped_pages(cursor, tables, start_date, end_date)
+    skipped_pages = {(page_date, loc_num) for page_date, loc_num in scraped_pages if page_date > refresh_end}
+    pages_to_scrape = [(loc_num, page_date, table_name) for page_date, table_name in window for loc_num in range(1, 4)
+                       if should_scrape(cursor, loc_num, page_date, table_name, skipped_pages)]
+    connection.close()
+
+    # fetch all pages at once and archive them, or find them in the archive when replaying
+    if settings['replay']:
+        logger.debug(f'Reading {len(pages_to_scrape)} pages from archive')
+        archived_pages = load_latest_hashes()
+        page_hashes = [archived_pages.get((page_date, loc_num)) for loc_num, page_date, _ in pages_to_scrape]
+    else:
+        logger.debug(f'Fetching {len(pages_to_scrape)} pages')
+        pages = fetch_pages([get_url(loc_num, page_date) for loc_num, page_date, _ in pages_to_scrape])
+        fetched = datetime.now()
+        page_hashes = [archive_page(page, loc_num, page_date, fetched) if page is not None else None
+                       for (loc_num, page_date, _), page in zip(pages_to_scrape, pages)]
+
+    output = [{'location': loc_num, 'date': page_date.strftime('%Y-%m-%d'), 'table': table_name, 'hash': page_hash}
+              for (loc_num, page_date, table_name), page_hash in zip(pages_to_scrape, page_hashes)]
+    return output, {'pages': len(output), 'pages_fetched': sum(page_hash is not None for page_hash in page_hashes)}
+
+def parse_stage(settings: dict, pages: list):
+    """ parses archived pages. Outputs list of pages, with their (mealtime, recipe) or None if the
+    page had no data """
+    logger = get_logger()
+    output = []
+    for page in pages:
+        if page['hash'] is None:
+            logger.warning(f'SCRAPE CANCELLED from {LOCATION_CODES[page["location"]]}, {page["date"]}. Page could not be '\
+                           f'{"found in archive" if settings["replay"] else "fetched"}')
+            continue
+        logger.debug(f'Scraping from {LOCATION_CODES[page["location"]]}, {page["date"]}')
+        output.append({**page, 'menu_items': parse_menu(read_page(page['hash']))})
+    return output, {'pages': len(output), 'menu_items': sum(len(page['menu_items'] or []) for page in output)}
+
+def write_stage(settings: dict, pages: list):
+    """ writes changes to parsed pages into database, logs the new menus, commits, and syncs the
+    replica """
+    connection = connect()
+    cursor = connection.cursor()
+
+    # read hashes of the recipes last written, to skip pages that haven't changed
+    window = get_window(settings)
+    page_hashes = get_page_hashes(cursor, window[0][0], window[-1][0])
+
+    # write pages in order
+    num_added, num_removed = 0, 0
+    for page in pages:
+        page_date = datetime.strptime(page['date'], '%Y-%m-%d')
+        menu_items = None if page['menu_items'] is None else [tuple(item) for item in page['menu_items']]
+        added, removed = store_menu(cursor, menu_items, page['location'], page_date, page['table'],
+                                    page_hashes.get((page_date, page['location'])))
+        num_added, num_removed = num_added + added, num_removed + removed
+
+    # log the new menus with them, so the web app refreshes its cached searches even if a later stage fails
+    mark_scrape_completed(cursor)
+
+    # commit writes
+    connection.commit()
+    sync_configured_replica(cursor)
+    connection.close()
+    return None, {'pages': len(pages), 'rows_added': num_added, 'rows_removed': num_removed}
+
+def export_stage(settings: dict, _):
+    """ exports months changed by this run into the dataset for training models """
+    connection = connect()
+    num_months, num_rows = export_training_data(connection.cursor(), datetime.strptime(settings['start'], '%Y-%m-%d'))
+    connection.close()
+    return None, {'months': num_months, 'rows': num_rows}
+
+def train_stage(settings: dict, _):
+    """ updates models with days settled since the last run, or retrains them on the whole dataset
+    when needed. Outputs predictions for each location """
+    predictions, summaries = compute_predictions_incremental(
+        TRAINING_DATASET_DIR, datetime.strptime(settings['start'], '%Y-%m-%d'), settings.get('retrain', False))
+    for location_code, summary in summaries.items():
+        get_logger().debug(f'Trained {LOCATION_CODES[location_code]}: {summary}')
+    output = {location_code: [[row[0]] + [date.strftime('%Y-%m-%d') for date in row[1:]] for row in predictions_array]
+              for location_code, predictions_array in predictions.items()}
+    return output, {'foods': sum(len(rows) for rows in output.values()),
+                    'rows_trained': sum(summary['rows'] for summary in summaries.values()),
+                    'full_retrains': sum(summary['mode'] == 'full' for summary in summaries.values())}
+
+def publish_stage(settings: dict, predictions: dict):
+    """ saves predictions into database, logs the completed run, commits, and syncs the replica """
+    connection = connect()
+    cursor = connection.cursor()
+    predictions = {int(location_code): [[row[0]] + [datetime.strptime(date, '%Y-%m-%d') for date in row[1:]]
+                                        for row in rows]
+                   for location_code, rows in predictions.items()}
+    generation = publish_predictions(predictions, cursor)
+    num_rows = sum(len(row) - 1 for rows in predictions.values() for row in rows)
+
+    # log completed run again so the web app reloads its predictions
+    mark_scrape_completed(cursor)
+
+    # commit writes
+    connection.commit()
+    sync_configured_replica(cursor)
+    connection.close()
+    return None, {'predictions': num_rows, 'generation': generation}
+
+STAGE_FUNCTIONS = {'fetch': fetch_stage, 'parse': parse_stage, 'write': write_stage,
+                   'export': export_stage, 'train': train_stage, 'publish': publish_stage}
+
+# define checkpoint methods
+def get_checkpoint_path(stage: str):
+    """ returns path of the checkpoint file of a stage """
+    return os.path.join(CHECKPOINT_DIR, f'{stage}.json')
+
+def load_checkpoint(stage: str):
+    """ returns saved checkpoint of a stage, or None if it hasn't completed """
+    path = get_checkpoint_path(stage)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def save_checkpoint(stage: str, output, counts: dict, seconds: float):
+    """ saves output, counts, and timing of a completed stage, and removes checkpoints of the
+    stages after it, since they used the old output """
+    checkpoint = {'stage': stage, 'completed': datetime.now().isoformat(timespec='seconds'),
+                  'seconds': round(seconds, 3), 'counts': counts, 'output': output}
+    path = get_checkpoint_path(stage)
+    with open(path + '.tmp', 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file)
+    os.replace(path + '.tmp', path)
+    for later_stage in STAGES[STAGES.index(stage) + 1:]:
+        if os.path.exists(get_checkpoint_path(later_stage)):
+            os.remove(get_checkpoint_path(later_stage))
+
+def start_run(settings: dict, restart: bool):
+    """ keeps checkpoints of an unfinished run with the same settings, otherwise clears them """
+    run_path = os.path.join(CHECKPOINT_DIR, RUN_FILENAME)
+    previous_settings = None
+    if os.path.exists(run_path):
+        with open(run_path, encoding='utf-8') as file:
+            previous_settings = json.load(file)
+    if restart or previous_settings != settings or load_checkpoint(STAGES[-1]) is not None:
+        shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+        os.makedirs(CHECKPOINT_DIR)
+        with open(run_path, 'w', encoding='utf-8') as file:
+            json.dump(settings, file)
+
+def run_stage(stage: str, settings: dict):
+    """ runs one stage with the output of the stage before it, and saves its checkpoint """
+    logger = get_logger()
+    previous_output = None
+    if stage != STAGES[0]:
+        previous_stage = STAGES[STAGES.index(stage) - 1]
+        previous_checkpoint = load_checkpoint(previous_stage)
+        if previous_checkpoint is None:
+            raise RuntimeError(f'Stage {stage} needs stage {previous_stage} to complete first')
+        previous_output = previous_checkpoint['output']
+
+    logger.debug(f'Starting stage {stage}')
+    start = time.perf_counter()
+    output, counts = STAGE_FUNCTIONS[stage](settings, previous_output)
+    seconds = time.perf_counter() - start
+    save_checkpoint(stage, output, counts, seconds)
+    metrics.record_stage(stage, seconds, counts)
+    logger.info(f'Completed stage {stage} in {seconds:.2f}s: {counts}')
+
+if __name__ == '__main__':
+    # read arguments
+    parser = argparse.ArgumentParser(description='Scrape dining hall menus into the database')
+    parser.add_argument('--replay', action='store_true', help='read pages from the archive instead of the website')
+    parser.add_argument('--start', help='first date to scrape, YYYY-MM-DD (default today)')
+    parser.add_argument('--days', type=int, help=f'number of days after start to scrape (default {CHECK_DAYS_AHEAD})')
+    parser.add_argument('--stage', choices=STAGES, help='run only this stage, using the checkpoint of the one before it')
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoints and run every stage again')
+    parser.add_argument('--retrain', action='store_true', help='retrain models on the whole dataset instead of updating them')
+    args = parser.parse_args()
+    start_date = datetime.strptime(args.start, '%Y-%m-%d') if args.start else START_DATE
+    days = args.days if args.days is not None else CHECK_DAYS_AHEAD
+    # replaying rewrites every page whose parsed recipes differ from the database
+    settings = {'start': start_date.strftime('%Y-%m-%d'), 'days': days,
+                'refresh_days': days if args.replay else REFRESH_DAYS_AHEAD, 'replay': args.replay,
+                'retrain': args.retrain}
+
+    # Log range
+    logger = get_logger()
+    logger.debug(f'Search starting from {start_date.date()} to {(start_date + timedelta(days=days)).date()}')
+
+    # record timing of the stages run, even if one fails
+    status = 'failed'
+    try:
+        if args.stage:
+            # run one stage on its own, with the settings of the last run unless others were given
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            run_path = os.path.join(CHECKPOINT_DIR, RUN_FILENAME)
+            if os.path.exists(run_path) and not (args.start or args.days is not None or args.replay):
+                with open(run_path, encoding='utf-8') as file:
+                    settings = {**json.load(file), 'retrain': args.retrain}
+            run_stage(args.stage, settings)
+        else:
+            # resume from the first stage without a checkpoint
+            start_run(settings, args.restart)
+            for stage in STAGES:
+                if load_checkpoint(stage) is None:
+                    run_stage(stage, settings)
+                else:
+                    logger.debug(f'Skipping stage {stage}, completed by an earlier run')
+        status = 'ok'
+    finally:
+        append_run_history(metrics.to_record(settings, status))
+
+    if not args.stage:
+        # log success
+        tables = list(dict.fromkeys(table_name for _, table_name in get_window(settings)))
+        logger.info(f'Successfully scraped from {start_date.date()} to '\
+                    f'{(start_date + timedelta(days=days)).date()} and stored into tables {", ".join(tables)}')
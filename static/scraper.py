@@ -1,28 +1,49 @@
 # scraper.py
 # Scrapes and stores recipes from a UT austin menu URL into database
-# requires requests and BeautifulSoup4 (web scraping) and pyodbc (database connection) to be installed
+# requires requests (web scraping) and pyodbc (database connection) to be installed
 
+import hashlib
 import logging
 import os
 import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
+from urllib.parse import urlparse
 import pyodbc
-from requests import get
-from bs4 import BeautifulSoup
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # import methods from searchdb: Add the parent directory to the system path to access it
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from searchdb import MEALTIME_CODES, LOCATION_CODES
+from searchdb import MEALTIME_CODES, LOCATION_CODES, insert_rows, menu_catalog
+from telemetry import metrics
 
+# fetching settings: total workers, workers per host, seconds to wait for a page, and retries of
+# failed requests, waiting RETRY_BACKOFF * 2^n seconds between them
+FETCH_WORKERS = int(os.getenv('SCRAPER_FETCH_WORKERS', '8'))
+FETCH_PER_HOST = int(os.getenv('SCRAPER_FETCH_PER_HOST', '4'))
+FETCH_TIMEOUT = float(os.getenv('SCRAPER_FETCH_TIMEOUT', '20'))
+FETCH_RETRIES = int(os.getenv('SCRAPER_FETCH_RETRIES', '3'))
+RETRY_BACKOFF = float(os.getenv('SCRAPER_RETRY_BACKOFF', '0.5'))
+
+LOG_NAME = 'scraper.log'
+LOG_LEVEL = os.getenv('SCRAPER_LOG_LEVEL', 'DEBUG')
 def get_logger(): 
-    """ returns logger that this file writes to """
-    LOG_NAME = 'scraper.log'
-    LOG_LEVEL = logging.DEBUG
-    current_dir = os.path.dirname(__file__)
-    log_path = os.path.join(os.path.dirname(__file__), LOG_NAME)
-    logging.basicConfig(level=LOG_LEVEL, filename=log_path, filemode='w',
-                        format="%(asctime)s [%(levelname)s] %(filename)s: %(message)s")
-    return logging.getLogger(LOG_NAME)
+    """ returns logger that this file writes to, appending to LOG_NAME next to this file """
+    logger = logging.getLogger(LOG_NAME)
+
+    # configure the first time only, so runs add to the log instead of replacing it
+    if not logger.handlers:
+        handler = logging.FileHandler(os.path.join(os.path.dirname(__file__), LOG_NAME), mode='a')
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(filename)s: %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(LOG_LEVEL)
+    return logger
 
 def scraper_main(source_url: str, location_num: int, date: datetime, table_name: str, cursor: pyodbc.Cursor):
     """Scrapes and stores recipes from a UT austin menu URL into database
@@ -37,41 +58,104 @@ def scraper_main(source_url: str, location_num: int, date: datetime, table_name:
     logger = get_logger()
     logger.debug(f'Attempting to scrape with location {location_num}, date {date.date()}, and table {table_name}')
 
+    # check arguments and skip pages already scraped
+    if not should_scrape(cursor, location_num, date, table_name):
+        return
+
+    # scrape website and write to database
+    date = datetime(date.year, date.month, date.day)
+    stored_hash = get_page_hashes(cursor, date, date).get((date, location_num))
+    store_page(cursor, fetch_page(make_session(), source_url), location_num, date, table_name, stored_hash)
+
+def should_scrape(cursor: pyodbc.Cursor, location_num: int, date: datetime, table_name: str,
+                  scraped_pages: set = None):
+    """Returns true if the page for this location and date is valid and not yet scraped
+
+    :cursor: cursor to the database, only reads
+    :location_num: of location to scrape from, must be 1, 2, or 3
+    :date: to scrape from, recommended to be between 7 days ago and 14 days ahead
+    :table_name: name of table in database
+    :scraped_pages: from get_scraped_pages, checked instead of querying the database if given
+    """
+    logger = get_logger()
+
     # validate arguments
     if not is_valid_lnum(location_num):
         logger.warning(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
                        f'Location_num ({location_num}) is not valid.')
-        return
+        return False
     elif not is_valid_tname(cursor, table_name):
         logger.warning(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
                        f'Table ({table_name}) not found in database.')
-        return 
+        return False
     elif not is_valid_date(date):
         logger.debug(f'Date ({date.date()}) is not within recommended range, may not find data.')
 
     # write only if not already scraped
-    if is_scraped(cursor, table_name, location_num, date):
+    if scraped_pages is not None:
+        already_scraped = (datetime(date.year, date.month, date.day), location_num) in scraped_pages
+    else:
+        already_scraped = is_scraped(cursor, table_name, location_num, date)
+    if already_scraped:
         logger.debug(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
               f'Already scraped into {table_name}.')
-        return
-    else:
-        logger.debug(f'Begin scraping from {LOCATION_CODES[location_num]}, {date.date()}.')
-    
-    # scrape website
-    html_content = get_html_content(source_url, location_num, date)
+        return False
+    logger.debug(f'Begin scraping from {LOCATION_CODES[location_num]}, {date.date()}.')
+    return True
+
+def store_page(cursor: pyodbc.Cursor, page: str, location_num: int, date: datetime, table_name: str,
+               stored_hash: str = None):
+    """Parses a fetched menu page and writes changes to its recipes into database
+
+    :cursor: cursor to the database, executes writes.  DOES NOT COMMIT WRITE
+    :page: HTML text of the menu page, from fetch_page or fetch_pages
+    :location_num: of location the page is for, must be 1, 2, or 3
+    :date: the page is for, at midnight
+    :table_name: name of table in database
+    :stored_hash: hash of the page's recipes when last written, from get_page_hashes
+    """
+    store_menu(cursor, parse_menu(page), location_num, date, table_name, stored_hash)
+
+def store_menu(cursor: pyodbc.Cursor, menu_items: list, location_num: int, date: datetime, table_name: str,
+               stored_hash: str = None):
+    """Writes changes to a page's recipes into database, and returns (rows added, rows removed)
+
+    :cursor: cursor to the database, executes writes.  DOES NOT COMMIT WRITE
+    :menu_items: list of (mealtime, recipe) from parse_menu, or None if the page has no data
+    :location_num: of location the page is for, must be 1, 2, or 3
+    :date: the page is for, at midnight
+    :table_name: name of table in database
+    :stored_hash: hash of the page's recipes when last written, from get_page_hashes
+    """
+    logger = get_logger()
 
     # write only if there is data available
-    if html_content.find(text='No Data Available'):
+    if menu_items is None:
         logger.debug(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
                        f'No recipes found on page')
-        return
+        return 0, 0
+
+    # a page without menu tables is an error or maintenance page, or the markup changed.
+    # Never replace stored recipes with nothing
+    if not menu_items:
+        logger.warning(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
+                       f'Page has no menu tables, keeping stored recipes')
+        return 0, 0
+
+    # write only if the recipes changed since last time
+    page_hash = hash_menu(menu_items)
+    if page_hash == stored_hash:
+        logger.debug(f'SCRAPE CANCELLED from {LOCATION_CODES[location_num]}, {date.date()}. '\
+                       f'Recipes are unchanged')
+        return 0, 0
 
     # write to database
-    write(cursor, table_name, html_content, location_num, date)
-    # logger.debug('no writes occurred')
+    num_added, num_removed = write(cursor, table_name, menu_items, location_num, date)
+    save_page_hash(cursor, location_num, date, page_hash)
 
     # print success message
     logger.info(f'Successfully scraped and cursor-wrote from {LOCATION_CODES[location_num]}, {date.date()}')
+    return num_added, num_removed
 
 def is_valid_date(date: datetime):
     """ Returns true if date is within a valid range, between 7 days ago and 14 days ahead of today """
@@ -85,58 +169,204 @@ def is_valid_lnum(location_num: int):
 
 def is_valid_tname(cursor: pyodbc.Cursor, table_name: str):
     """ Returns true if table_name is a valid table name (present in database), false otherwise """
-    return cursor.tables(table=table_name, tableType='TABLE').fetchone() is not None
+    return table_name in menu_catalog.load(cursor)
 
-def get_html_content(source_url: str, location_num: int, date: datetime):
-    """Get HTML content
+def make_session():
+    """ returns requests session that keeps connections alive and retries failed requests with backoff """
+    retry = Retry(total=FETCH_RETRIES, backoff_factor=RETRY_BACKOFF, allowed_methods=['GET'],
+                  status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=max(FETCH_WORKERS, FETCH_PER_HOST))
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-    :source_url: for the location. should match location_num and date
-    :location_num: to scrape from, should be 1, 2, or 3
-    :date: to scrape from, recommended to be between 7 days ago or 14 days ahead
+def fetch_page(session: requests.Session, source_url: str):
+    """ returns HTML text of source_url, raising requests.RequestException if it can't be fetched
+
+    :session: from make_session, may be shared between threads
+    :source_url: page to fetch
     """
-    # Get HTML from website
-    html_content = get(source_url).text
+    start = time.perf_counter()
+    response = session.get(source_url, timeout=FETCH_TIMEOUT)
+    response.raise_for_status()
+    metrics.record_http(time.perf_counter() - start, len(response.content))
+    return response.text
+
+def fetch_pages(source_urls: list):
+    """ fetches pages concurrently, at most FETCH_PER_HOST at a time from each host, and returns
+    a list of HTML text in the same order as source_urls. Pages that failed are None
+
+    :source_urls: list of pages to fetch
+    """
+    logger = get_logger()
+    session = make_session()
+    host_limits = {urlparse(url).netloc: threading.BoundedSemaphore(FETCH_PER_HOST) for url in source_urls}
 
-    # Parse and return the HTML content
-    return BeautifulSoup(html_content, 'html.parser')
+    def fetch(source_url: str):
+        with host_limits[urlparse(source_url).netloc]:
+            try:
+                return fetch_page(session, source_url)
+            except requests.RequestException as e:
+                logger.warning(f'FETCH FAILED from {source_url}: {e}')
+                return None
 
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        pages = list(executor.map(fetch, source_urls))
+    session.close()
+    return pages
+
+# attributes of the table holding each mealtime and its recipes
+MENU_TABLE_ATTRS = {'border': '0', 'width': '100%', 'height': '100%', 'cellpadding': '0', 'cellspacing': '0'}
+NO_DATA_TEXT = 'No Data Available'
+
+class MenuPageParser(HTMLParser):
+    """ streams through a menu page, only collecting the text of mealtime and recipe divs
+
+    Each menu table starts a new mealtime. Recipes belong to the first mealtime of the innermost
+    menu table they are in, and repeated recipes in a mealtime are skipped.
+    """
+    def __init__(self):
+        super().__init__()
+        self.menu_items = []  # (mealtime, recipe) in page order
+        self.no_data = False  # page says there is no data
+        self._tables = []  # for each open table, [mealtime, recipes seen] if it is a menu table, else None
+        self._div_class = None  # class of the mealtime or recipe div being read
+        self._div_depth = 0  # divs open inside it
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'table':
+            is_menu = all(attrs.get(name) == value for name, value in MENU_TABLE_ATTRS.items())
+            self._tables.append([None, set()] if is_menu else None)
+        elif tag == 'div' and self._div_class is not None:
+            self._div_depth += 1
+        elif tag == 'div' and self._get_menu() is not None:
+            div_class = (attrs.get('class') or '').split()
+            if 'shortmenumeals' in div_class or 'shortmenurecipes' in div_class:
+                self._div_class = 'shortmenumeals' if 'shortmenumeals' in div_class else 'shortmenurecipes'
+                self._text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'table' and self._tables and self._div_class is None:
+            self._tables.pop()
+        elif tag == 'div' and self._div_class is not None and self._div_depth > 0:
+            self._div_depth -= 1
+        elif tag == 'div' and self._div_class is not None:
+            self._add(''.join(self._text))
+            self._div_class = None
+
+    def handle_data(self, data):
+        if data == NO_DATA_TEXT:
+            self.no_data = True
+        if self._div_class is not None:
+            self._text.append(data)
+
+    def _get_menu(self):
+        """ returns [mealtime, recipes seen] of the innermost menu table, or None outside of one """
+        for table in reversed(self._tables):
+            if table is not None:
+                return table
+        return None
+
+    def _add(self, text: str):
+        """ records the text of a finished mealtime or recipe div """
+        menu = self._get_menu()
+        if self._div_class == 'shortmenumeals':
+            if menu[0] is None:
+                menu[0] = text
+        elif menu[0] is not None and text not in menu[1]:
+            menu[1].add(text)
+            self.menu_items.append((menu[0], text.rstrip('\xa0')))
+
+def parse_menu(page: str):
+    """ returns list of (mealtime, recipe) on a menu page, or None if the page has no data
+
+    :page: HTML text of the menu page
+    """
+    parser = MenuPageParser()
+    parser.feed(page)
+    parser.close()
+    return None if parser.no_data else parser.menu_items
 
-def write(cursor: pyodbc.Cursor, table_name: str, html_content: BeautifulSoup, 
+def write(cursor: pyodbc.Cursor, table_name: str, menu_items: list, 
           location_num:int, date: datetime):
-    """ Filters, formats, and writes html_content to file
+    """ Writes the differences between menu_items and the rows already in database, so each
+    recipe is stored once per mealtime. Returns (rows added, rows removed)
 
     :cursor: cursor to execute queries, DOES NOT COMMIT WRITES
     :table_name: name of table in database to write to
-    :html_content: parsed html content
-    :location_num: of recipes in html_content, should be 1, 2, or 3
-    :date: of recipes in html_content
+    :menu_items: list of (mealtime, recipe), from parse_menu. Empty lists are not written
+    :location_num: of recipes in menu_items, should be 1, 2, or 3
+    :date: of recipes in menu_items, at midnight
     """
 
-    # Find each menu (mealtime and recipes)
-    menus = html_content.find_all('table', {'border': '0', 'width': '100%', 'height': '100%',
-                                     'cellpadding': '0', 'cellspacing': '0'})
+    # an empty parse would delete every stored row of the page
+    if not menu_items:
+        get_logger().warning(f'write skipped for {LOCATION_CODES[location_num]}, {date.date()}: no recipes given')
+        return 0, 0
 
-    # Find each mealtime and recipes then write it
-    for menu in menus:
-        # Find and encode mealtime
-        mealtime = MEALTIME_CODES.index(menu.find('div', class_='shortmenumeals').text)
+    # Encode each mealtime
+    rows = list(dict.fromkeys((MEALTIME_CODES.index(mealtime), recipe) for mealtime, recipe in menu_items))
 
-        # Find all recipes in recipe_table
-        recipe_list_raw = menu.find('tr').find_next_sibling().find_all('div', class_='shortmenurecipes')
+    # Compare with rows in database. Repeated rows are deleted and added back once
+    start = time.perf_counter()
+    cursor.execute(f'SELECT Mealtime, Recipe FROM {table_name} WHERE [Date]=? AND [Location]=?', (date, location_num))
+    existing = Counter((row.Mealtime, row.Recipe) for row in cursor.fetchall())
+    removed = [row for row, count in existing.items() if count > 1 or row not in rows]
+    added = [row for row in rows if existing[row] != 1]
 
-        # Remove duplicates
-        recipe_list = []
-        [recipe_list.append(x) for x in recipe_list_raw if x not in recipe_list]
-
-        # Write each recipe
-        for recipe in recipe_list:
-            instr = f"INSERT INTO {table_name} (Recipe, [Date], Mealtime, [Location]) VALUES (?, ?, ?, ?)"
-            cursor.execute(instr, recipe.text.rstrip('\xa0'), date, mealtime, location_num) 
+    # Delete and insert the differences in batches
+    if removed:
+        instr = f'DELETE FROM {table_name} WHERE [Date]=? AND [Location]=? AND Mealtime=? AND Recipe=?'
+        cursor.executemany(instr, [(date, location_num, mealtime, recipe) for mealtime, recipe in removed])
+    insert_rows(cursor, table_name, ['Recipe', '[Date]', 'Mealtime', '[Location]'],
+                [(recipe, date, mealtime, location_num) for mealtime, recipe in added])
+    metrics.record_db_write(time.perf_counter() - start, len(added) + len(removed))
 
     # Log a success message
     logger = get_logger()
     logger.debug(f'Recipes from {LOCATION_CODES[location_num]} on {date.date()} has '\
-          f'been successfully written to table {table_name}')
+          f'been successfully written to table {table_name}: {len(added)} added, {len(removed)} removed')
+    return len(added), len(removed)
+
+PAGE_HASH_TABLE_NAME = 'page_hashes'
+def hash_menu(menu_items: list):
+    """ returns hex digest identifying the recipes of a page, ignoring their order
+
+    :menu_items: list of (mealtime, recipe), from parse_menu. Empty lists are not written
+    """
+    text = '\n'.join(sorted(f'{mealtime}\t{recipe}' for mealtime, recipe in set(menu_items)))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_page_hashes(cursor: pyodbc.Cursor, start_date: datetime, end_date: datetime):
+    """Returns dictionary of (date, location_num): hash of recipes last written, for pages between
+    start_date and end_date. Creates the table of hashes if it doesn't exist. DOES NOT COMMIT
+
+    :cursor: cursor to database
+    :start_date: first date to read
+    :end_date: last date to read
+    """
+    start_date = datetime(start_date.year, start_date.month, start_date.day)
+    end_date = datetime(end_date.year, end_date.month, end_date.day)
+    cursor.execute(f"IF OBJECT_ID('{PAGE_HASH_TABLE_NAME}', 'U') IS NULL "\
+                   f"CREATE TABLE {PAGE_HASH_TABLE_NAME} ([Date] datetime, [Location] int, Hash char(64), Updated datetime)")
+    cursor.execute(f'SELECT [Date], [Location], Hash FROM {PAGE_HASH_TABLE_NAME} WHERE [Date] BETWEEN ? AND ?',
+                   (start_date, end_date))
+    return {(row.Date, row.Location): row.Hash for row in cursor.fetchall()}
+
+def save_page_hash(cursor: pyodbc.Cursor, location_num: int, date: datetime, page_hash: str):
+    """Stores the hash of a page's recipes after writing them. DOES NOT COMMIT
+
+    :cursor: cursor to database, executes writes
+    :location_num: of location the page is for
+    :date: the page is for, at midnight
+    :page_hash: from hash_menu
+    """
+    cursor.execute(f'DELETE FROM {PAGE_HASH_TABLE_NAME} WHERE [Date]=? AND [Location]=?', (date, location_num))
+    cursor.execute(f'INSERT INTO {PAGE_HASH_TABLE_NAME} ([Date], [Location], Hash, Updated) VALUES (?, ?, ?, ?)',
+                   (date, location_num, page_hash, datetime.now()))
 
 def is_scraped(cursor: pyodbc.Cursor, table_name: str, location_num: int, date: datetime):
     """Checks if this day and location have already been scraped into database
@@ -154,3 +384,23 @@ def is_scraped(cursor: pyodbc.Cursor, table_name: str, location_num: int, date:
 
     # Convert to boolean and return
     return len(cursor.fetchall()) != 0  
+
+def get_scraped_pages(cursor: pyodbc.Cursor, table_names: list, start_date: datetime, end_date: datetime):
+    """Returns set of (date, location_num) already scraped into database between start_date and
+    end_date, in one query
+
+    :cursor: cursor to database
+    :table_names: names of tables in database covering the dates, must exist
+    :start_date: first date to check
+    :end_date: last date to check
+    """
+    start_date = datetime(start_date.year, start_date.month, start_date.day)
+    end_date = datetime(end_date.year, end_date.month, end_date.day)
+    if not table_names:
+        return set()
+
+    # find the distinct days and locations of every table at once
+    instr = ' UNION '.join(f'SELECT DISTINCT [Date], [Location] FROM {table_name} WHERE [Date] BETWEEN ? AND ?'
+                           for table_name in table_names)
+    cursor.execute(instr, (start_date, end_date) * len(table_names))
+    return {(datetime(row.Date.year, row.Date.month, row.Date.day), row.Location) for row in cursor.fetchall()}
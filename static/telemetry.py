@@ -0,0 +1,144 @@
+# telemetry.py
+# collects timing and throughput of each scraper run, and appends them to RUN_HISTORY_PATH as
+# one JSON object per line. Compare the latest run with earlier ones with:
+#   python telemetry.py [--runs 10]
+
+import argparse
+import bisect
+import json
+import os
+import statistics
+import threading
+from datetime import datetime
+
+RUN_HISTORY_PATH = os.getenv('SCRAPER_RUN_HISTORY', os.path.join(os.path.dirname(__file__), 'run_history.jsonl'))
+# upper bounds in seconds of latency histogram buckets, the last bucket is everything slower
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10]
+# count of each stage that its throughput is measured in
+STAGE_RATE_COUNTS = {'fetch': 'pages', 'parse': 'pages', 'write': 'rows_added', 'export': 'rows',
+                     'train': 'foods', 'publish': 'predictions'}
+
+class RunMetrics:
+    """ thread-safe collection of one run's metrics """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = datetime.now()
+        self.stages = {}  # stage: {'seconds', 'counts'}
+        self._http_latencies = []
+        self._http_bytes = 0
+        self._db_write_latencies = []
+        self._db_write_rows = 0
+
+    def record_stage(self, stage: str, seconds: float, counts: dict):
+        """ records time taken and row counts of a completed stage """
+        with self._lock:
+            self.stages[stage] = {'seconds': round(seconds, 3), 'counts': counts}
+
+    def record_http(self, seconds: float, num_bytes: int):
+        """ records one fetched page """
+        with self._lock:
+            self._http_latencies.append(seconds)
+            self._http_bytes += num_bytes
+
+    def record_db_write(self, seconds: float, num_rows: int):
+        """ records one page's writes to database """
+        with self._lock:
+            self._db_write_latencies.append(seconds)
+            self._db_write_rows += num_rows
+
+    def to_record(self, settings: dict, status: str):
+        """ returns dictionary describing the run, for the run history """
+        with self._lock:
+            stages = {stage: {**metrics, 'rate': get_rate(stage, metrics)} for stage, metrics in self.stages.items()}
+            return {
+                'started': self.started.isoformat(timespec='seconds'),
+                'seconds': round((datetime.now() - self.started).total_seconds(), 3),
+                'status': status,
+                'settings': settings,
+                'stages': stages,
+                'http': {**summarize_latencies(self._http_latencies), 'bytes': self._http_bytes},
+                'db_writes': {**summarize_latencies(self._db_write_latencies), 'rows': self._db_write_rows},
+            }
+
+# metrics of the current run
+metrics = RunMetrics()
+
+def get_rate(stage: str, stage_metrics: dict):
+    """ returns throughput of a stage in its STAGE_RATE_COUNTS per second, or None """
+    count = stage_metrics['counts'].get(STAGE_RATE_COUNTS.get(stage))
+    if count is None or stage_metrics['seconds'] <= 0:
+        return None
+    return round(count / stage_metrics['seconds'], 2)
+
+def summarize_latencies(latencies: list):
+    """ returns dictionary with count, p50, p95, max, and histogram of latencies in seconds """
+    if not latencies:
+        return {'count': 0}
+    histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+    for latency in latencies:
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+    latencies = sorted(latencies)
+    return {'count': len(latencies), 'p50': round(latencies[len(latencies) // 2], 4),
+            'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 4),
+            'max': round(latencies[-1], 4), 'histogram': histogram}
+
+def append_run_history(record: dict, path: str = None):
+    """ appends a run's record to the run history """
+    with open(path or RUN_HISTORY_PATH, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record) + '\n')
+
+def load_run_history(path: str = None):
+    """ returns list of run records, oldest first """
+    path = path or RUN_HISTORY_PATH
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def report(num_runs: int, path: str = None):
+    """ prints the latest run's stage timings and throughput next to the median of the num_runs
+    runs before it """
+    runs = load_run_history(path)
+    if not runs:
+        print('No runs recorded yet')
+        return
+    latest, earlier = runs[-1], runs[-num_runs - 1:-1]
+    print(f'Latest run {latest["started"]} ({latest["status"]}, {latest["seconds"]:.1f}s), '\
+          f'compared with median of {len(earlier)} earlier runs')
+
+    def median(values: list):
+        values = [value for value in values if value is not None]
+        return statistics.median(values) if values else None
+
+    def format_change(value, baseline):
+        if value is None or not baseline:
+            return ''
+        return f'{(value - baseline) / baseline * 100:+.0f}%'
+
+    print(f'{"stage":<10} {"seconds":>9} {"median":>9} {"change":>7} {"rate/s":>9} {"median":>9}')
+    for stage, stage_metrics in latest['stages'].items():
+        seconds = stage_metrics['seconds']
+        median_seconds = median([run['stages'][stage]['seconds'] for run in earlier if stage in run['stages']])
+        rate = stage_metrics.get('rate')
+        median_rate = median([run['stages'][stage].get('rate') for run in earlier if stage in run['stages']])
+        print(f'{stage:<10} {seconds:>9.2f} {median_seconds if median_seconds is not None else "":>9} '\
+              f'{format_change(seconds, median_seconds):>7} {rate if rate is not None else "":>9} '\
+              f'{median_rate if median_rate is not None else "":>9}')
+
+    for name in ['http', 'db_writes']:
+        summary = latest[name]
+        if summary['count'] == 0:
+            continue
+        median_p95 = median([run[name].get('p95') for run in earlier])
+        extra = f', {summary["bytes"] / 1e6:.2f} MB' if name == 'http' else f', {summary["rows"]} rows'
+        print(f'{name}: {summary["count"]} calls{extra}, p50 {summary["p50"]}s, p95 {summary["p95"]}s '\
+              f'{format_change(summary["p95"], median_p95)}, histogram {summary["histogram"]} '\
+              f'(buckets up to {LATENCY_BUCKETS}s)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the latest scraper run with earlier runs')
+    parser.add_argument('--runs', type=int, default=10, help='number of earlier runs to compare with')
+    parser.add_argument('--history', help=f'run history file (default {RUN_HISTORY_PATH})')
+    args = parser.parse_args()
+    report(args.runs, args.history)
@@ -0,0 +1,91 @@
+# training_data.py
+# exports the monthly menu tables into a Parquet dataset for training prediction models, with one
+# file per month in TRAINING_DATASET_DIR. Updated by run_scraper.py after it commits, or manually:
+#   python training_data.py (reads Azure SQL connection details from environment variables)
+# requires pyarrow to be installed
+
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyodbc
+from datetime import datetime
+from searchdb import get_server_connection, get_month_start, get_table_month, menu_catalog
+
+TRAINING_DATASET_DIR = os.getenv('TRAINING_DATASET_DIR', 'training_data')
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '50000'))
+# typed columns of each monthly file
+TRAINING_SCHEMA = pa.schema([('Recipe', pa.string()), ('Date', pa.timestamp('s')),
+                             ('Mealtime', pa.int8()), ('Location', pa.int8())])
+
+def export_training_data(cursor: pyodbc.Cursor, since: datetime, dataset_dir: str = None):
+    """ writes monthly tables into the dataset, streaming rows in chunks of EXPORT_CHUNK_ROWS, and
+    returns (months written, rows written)
+
+    Months before since were written by earlier runs and don't change, so only months from
+    since onwards, and months missing from the dataset, are written.
+
+    :param cursor: cursor to the database, only reads
+    :param since: first date that may have changed since the last export
+    :param dataset_dir: defaults to TRAINING_DATASET_DIR
+    """
+    dataset_dir = dataset_dir or TRAINING_DATASET_DIR
+    os.makedirs(dataset_dir, exist_ok=True)
+    exported = set(os.listdir(dataset_dir))
+
+    # find which monthly tables to write
+    since_month = get_month_start(since)
+    tables = sorted((table for table in menu_catalog.load(cursor)
+                     if f'{table}.parquet' not in exported or get_table_month(table) >= since_month),
+                    key=get_table_month)
+
+    num_rows = sum(export_table(cursor, table, os.path.join(dataset_dir, f'{table}.parquet')) for table in tables)
+    print(f'export_training_data completed: wrote {len(tables)} months into {dataset_dir}')
+    return len(tables), num_rows
+
+def export_table(cursor: pyodbc.Cursor, table: str, path: str):
+    """ writes one monthly table to a Parquet file, replacing it only once complete, and returns
+    number of rows written
+
+    :param cursor: cursor to the database, only reads
+    :param table: name of monthly table
+    :param path: file to write
+    """
+    cursor.execute(f'SELECT Recipe, [Date], Mealtime, [Location] FROM {table}')
+    num_rows = 0
+    with pq.ParquetWriter(path + '.tmp', TRAINING_SCHEMA) as writer:
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            num_rows += len(rows)
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch([pa.array(column, type=field.type)
+                                                for column, field in zip(columns, TRAINING_SCHEMA)],
+                                               schema=TRAINING_SCHEMA))
+    os.replace(path + '.tmp', path)
+    return num_rows
+
+def load_training_data(dataset_dir: str = None, since: datetime = None):
+    """ returns DataFrame of exported menu rows, sorted by Recipe, Date, and Mealtime
+
+    :param dataset_dir: defaults to TRAINING_DATASET_DIR
+    :param since: if given, only rows on or after this date are returned, and only the months
+        containing them are read
+    """
+    dataset_dir = dataset_dir or TRAINING_DATASET_DIR
+    file_names = sorted(file_name for file_name in os.listdir(dataset_dir) if file_name.endswith('.parquet'))
+    if since is not None:
+        # skip months before since, files not named after a monthly table are always read
+        file_names = [file_name for file_name in file_names
+                      if (get_table_month(file_name[:-len('.parquet')]) or since) >= get_month_start(since)]
+    paths = [os.path.join(dataset_dir, file_name) for file_name in file_names]
+    food_db = pa.concat_tables([pq.read_table(path, schema=TRAINING_SCHEMA) for path in paths]).to_pandas() \
+        if paths else TRAINING_SCHEMA.empty_table().to_pandas()
+    if since is not None:
+        food_db = food_db[food_db['Date'] >= since]
+    return food_db.sort_values(['Recipe', 'Date', 'Mealtime'], kind='stable', ignore_index=True)
+
+if __name__ == '__main__':
+    connection = get_server_connection()
+    export_training_data(connection.cursor(), datetime.today())
+    connection.close()